@@ -0,0 +1,89 @@
+"""key dream prompt search by id
+
+Revision ID: 3a6f0d92c5b4
+Revises: e29b5f47a6c0
+Create Date: 2022-10-19 10:21:36.417825
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a6f0d92c5b4'
+down_revision = 'e29b5f47a6c0'
+branch_labels = None
+depends_on = None
+
+
+def drop_search_index():
+    op.execute("DROP TRIGGER dreams_fts_update")
+    op.execute("DROP TRIGGER dreams_fts_delete")
+    op.execute("DROP TRIGGER dreams_fts_insert")
+    op.execute("DROP TABLE dreams_fts")
+
+
+def upgrade() -> None:
+    # `dreams` has a string primary key, so its implicit rowid isn't stable
+    # (VACUUM can renumber it) and can't key an external-content index.
+    # Store each prompt along with its dream's ID instead
+    drop_search_index()
+
+    op.execute("""
+        CREATE VIRTUAL TABLE dreams_fts USING fts5(
+            dream_id UNINDEXED,
+            prompt,
+            tokenize='porter unicode61'
+        )
+    """)
+
+    # Keep the index in sync with the dreams table. Dreams are rarely
+    # deleted or edited, so finding their rows by scanning is fine
+    op.execute("""
+        CREATE TRIGGER dreams_fts_insert AFTER INSERT ON dreams BEGIN
+            INSERT INTO dreams_fts(dream_id, prompt) VALUES (new.id, new.prompt);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER dreams_fts_delete AFTER DELETE ON dreams BEGIN
+            DELETE FROM dreams_fts WHERE dream_id = old.id;
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER dreams_fts_update AFTER UPDATE OF id, prompt ON dreams BEGIN
+            DELETE FROM dreams_fts WHERE dream_id = old.id;
+            INSERT INTO dreams_fts(dream_id, prompt) VALUES (new.id, new.prompt);
+        END
+    """)
+
+    op.execute("INSERT INTO dreams_fts(dream_id, prompt) SELECT id, prompt FROM dreams")
+
+
+def downgrade() -> None:
+    drop_search_index()
+
+    op.execute("""
+        CREATE VIRTUAL TABLE dreams_fts USING fts5(
+            prompt,
+            content='dreams',
+            content_rowid='rowid',
+            tokenize='porter unicode61'
+        )
+    """)
+    op.execute("""
+        CREATE TRIGGER dreams_fts_insert AFTER INSERT ON dreams BEGIN
+            INSERT INTO dreams_fts(rowid, prompt) VALUES (new.rowid, new.prompt);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER dreams_fts_delete AFTER DELETE ON dreams BEGIN
+            INSERT INTO dreams_fts(dreams_fts, rowid, prompt) VALUES ('delete', old.rowid, old.prompt);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER dreams_fts_update AFTER UPDATE OF prompt ON dreams BEGIN
+            INSERT INTO dreams_fts(dreams_fts, rowid, prompt) VALUES ('delete', old.rowid, old.prompt);
+            INSERT INTO dreams_fts(rowid, prompt) VALUES (new.rowid, new.prompt);
+        END
+    """)
+    op.execute("INSERT INTO dreams_fts(dreams_fts) VALUES ('rebuild')")
@@ -0,0 +1,26 @@
+"""add dream history indexes
+
+Revision ID: 5b7e2c9a41f3
+Revises: d1eefba574a1
+Create Date: 2022-10-18 09:12:41.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e2c9a41f3'
+down_revision = 'd1eefba574a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_dreams_created_at', 'dreams', ['created_at', 'id'])
+    op.create_index('ix_dream_images_dream_id', 'dream_images', ['dream_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_dream_images_dream_id', table_name='dream_images')
+    op.drop_index('ix_dreams_created_at', table_name='dreams')
@@ -0,0 +1,57 @@
+"""add dream prompt search
+
+Revision ID: 8f3d61c0b2e7
+Revises: 5b7e2c9a41f3
+Create Date: 2022-10-18 11:47:05.902318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f3d61c0b2e7'
+down_revision = '5b7e2c9a41f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # An external-content FTS5 index over `dreams.prompt`, so prompts
+    # aren't stored twice
+    op.execute("""
+        CREATE VIRTUAL TABLE dreams_fts USING fts5(
+            prompt,
+            content='dreams',
+            content_rowid='rowid',
+            tokenize='porter unicode61'
+        )
+    """)
+
+    # Keep the index in sync with the dreams table
+    op.execute("""
+        CREATE TRIGGER dreams_fts_insert AFTER INSERT ON dreams BEGIN
+            INSERT INTO dreams_fts(rowid, prompt) VALUES (new.rowid, new.prompt);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER dreams_fts_delete AFTER DELETE ON dreams BEGIN
+            INSERT INTO dreams_fts(dreams_fts, rowid, prompt) VALUES ('delete', old.rowid, old.prompt);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER dreams_fts_update AFTER UPDATE OF prompt ON dreams BEGIN
+            INSERT INTO dreams_fts(dreams_fts, rowid, prompt) VALUES ('delete', old.rowid, old.prompt);
+            INSERT INTO dreams_fts(rowid, prompt) VALUES (new.rowid, new.prompt);
+        END
+    """)
+
+    # Index the dreams that already exist
+    op.execute("INSERT INTO dreams_fts(dreams_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER dreams_fts_update")
+    op.execute("DROP TRIGGER dreams_fts_delete")
+    op.execute("DROP TRIGGER dreams_fts_insert")
+    op.execute("DROP TABLE dreams_fts")
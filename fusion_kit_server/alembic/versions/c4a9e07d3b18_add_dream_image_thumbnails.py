@@ -0,0 +1,32 @@
+"""add dream image thumbnails
+
+Revision ID: c4a9e07d3b18
+Revises: 8f3d61c0b2e7
+Create Date: 2022-10-18 15:03:27.664190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4a9e07d3b18'
+down_revision = '8f3d61c0b2e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'dream_image_thumbnails',
+        sa.Column('dream_image_id', sa.String, sa.ForeignKey('dream_images.id'), primary_key=True),
+        sa.Column('size', sa.Integer, primary_key=True),
+        sa.Column('format', sa.String, nullable=False),
+        sa.Column('image_path', sa.String, nullable=False),
+        sa.Column('width', sa.Integer, nullable=False),
+        sa.Column('height', sa.Integer, nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('dream_image_thumbnails')
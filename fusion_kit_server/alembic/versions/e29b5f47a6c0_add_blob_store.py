@@ -0,0 +1,43 @@
+"""add blob store
+
+Revision ID: e29b5f47a6c0
+Revises: c4a9e07d3b18
+Create Date: 2022-10-18 17:26:52.130947
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e29b5f47a6c0'
+down_revision = 'c4a9e07d3b18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'blobs',
+        sa.Column('hash', sa.String, primary_key=True),
+        sa.Column('extension', sa.String, nullable=False),
+        sa.Column('size', sa.Integer, nullable=False),
+        sa.Column('ref_count', sa.Integer, nullable=False, server_default='0'),
+    )
+
+    # Existing images keep their original paths, so these are only set for
+    # images saved from now on
+    op.add_column('dreams', sa.Column('base_image_blob_hash', sa.String, nullable=True))
+    op.add_column('dreams', sa.Column('base_image_mask_blob_hash', sa.String, nullable=True))
+    op.add_column('dream_images', sa.Column('blob_hash', sa.String, nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('dream_images') as batch_op:
+        batch_op.drop_column('blob_hash')
+
+    with op.batch_alter_table('dreams') as batch_op:
+        batch_op.drop_column('base_image_mask_blob_hash')
+        batch_op.drop_column('base_image_blob_hash')
+
+    op.drop_table('blobs')
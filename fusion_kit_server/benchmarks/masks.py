@@ -0,0 +1,66 @@
+"""
+Compare mask preparation against the old per-pixel implementation.
+
+Run from the `fusion_kit_server` directory:
+
+    python -m benchmarks.masks
+"""
+
+import argparse
+import timeit
+from PIL import Image, ImageDraw
+from processor.masks import prepare_image_mask
+
+DEFAULT_SIZES = (512, 1024, 2048)
+
+def legacy_prepare_image_mask(mask, mask_type):
+    if mask_type == 'KEEP_MASKED':
+        return mask
+    elif mask_type == 'REPLACE_MASKED':
+        mask_data = mask.convert("RGBA").getdata()
+        new_mask_data = [(pixel[0], pixel[1], pixel[2], 255 - pixel[3]) for pixel in mask_data]
+
+        new_mask = Image.new(mode="RGBA", size=mask.size)
+        new_mask.putdata(new_mask_data)
+
+        return new_mask
+    else:
+        raise Exception(f'Unknown mask type: {mask_type}')
+
+def make_mask(size):
+    mask = Image.new(mode='RGBA', size=(size, size), color=(0, 0, 0, 0))
+    draw = ImageDraw.Draw(mask)
+    draw.ellipse((size // 4, size // 4, size * 3 // 4, size * 3 // 4), fill=(0, 0, 0, 255))
+    return mask
+
+def time_ms(function, repeat):
+    return min(timeit.repeat(function, number=1, repeat=repeat)) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mask preparation')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES), help='comma-separated list of mask sizes (in pixels)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs to take the fastest of')
+    args = parser.parse_args()
+
+    cases = [
+        ('legacy invert', lambda mask: legacy_prepare_image_mask(mask, 'REPLACE_MASKED')),
+        ('invert', lambda mask: prepare_image_mask(mask, 'REPLACE_MASKED')),
+        ('invert + feather 8', lambda mask: prepare_image_mask(mask, 'REPLACE_MASKED', feather=8)),
+        ('invert + dilate 8', lambda mask: prepare_image_mask(mask, 'REPLACE_MASKED', dilate=8)),
+    ]
+
+    print(f"{'size':>6}  {'case':<20} {'time':>10}")
+    for size in (int(size) for size in args.sizes.split(',')):
+        mask = make_mask(size)
+
+        # The new path has to give the same result as the old one
+        expected = legacy_prepare_image_mask(mask, 'REPLACE_MASKED')
+        actual = prepare_image_mask(mask, 'REPLACE_MASKED')
+        assert expected.tobytes() == actual.tobytes(), 'inverted masks differ'
+
+        for name, function in cases:
+            elapsed_ms = time_ms(lambda: function(mask), repeat=args.repeat)
+            print(f"{size:>6}  {name:<20} {elapsed_ms:>8.1f}ms")
+
+if __name__ == '__main__':
+    main()
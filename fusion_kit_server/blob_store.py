@@ -0,0 +1,144 @@
+import hashlib
+from io import BytesIO
+import os
+import re
+import time
+import uuid
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.sqlite import insert
+import db
+
+BLOBS_DIRNAME = 'blobs'
+
+BLOB_HASH_REGEX = r'\A[0-9a-f]{64}\Z'
+
+BLOB_MEDIA_TYPES = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    'gif': 'image/gif',
+    'bmp': 'image/bmp',
+}
+
+# Blob files that aren't in the database yet could still be about to be
+# committed, so garbage collection leaves recent ones alone
+ORPHAN_GRACE_SECONDS = 60 * 60
+
+def is_blob_hash(value):
+    return re.match(BLOB_HASH_REGEX, value) is not None
+
+class BlobStore():
+    """
+    Content-addressed storage for image files, under `<images_dir>/blobs`.
+
+    Each blob is stored once, named by the SHA-256 hash of its contents, so
+    writing the same image again (such as re-uploading a base image, or
+    re-running a dream with the same seed) is free. Blob files are written
+    from worker threads, while references to them are counted in the
+    `blobs` table in the same transaction as the rows that use them (and
+    released when those rows are deleted). Blobs that are no longer
+    referenced, and blob files that never made it into the database, get
+    deleted by `collect_garbage`.
+    """
+
+    def __init__(self, images_dir):
+        self.images_dir = images_dir
+
+    def relative_path(self, blob_hash, extension):
+        return os.path.join(BLOBS_DIRNAME, blob_hash[:2], f'{blob_hash}.{extension}')
+
+    def path(self, blob_hash, extension):
+        return os.path.join(self.images_dir, self.relative_path(blob_hash, extension))
+
+    def put(self, data, extension):
+        """
+        Store `data` unless an identical blob is already stored. Returns the
+        details of the blob, which must be passed to `add_ref` for the blob
+        to be kept.
+        """
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(blob_hash, extension)
+
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Other threads could be writing the same blob, so each writes
+            # its own temporary file
+            temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            with open(temp_path, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+
+        return {
+            'hash': blob_hash,
+            'extension': extension,
+            'size': len(data),
+            'image_path': self.relative_path(blob_hash, extension),
+        }
+
+    def put_image(self, image, image_format):
+        data = BytesIO()
+        image.save(data, format=image_format)
+        return self.put(data.getvalue(), extension=image_format.lower())
+
+    def add_ref(self, session, blob):
+        session.execute(
+            insert(db.Blob)
+                .values(
+                    hash=blob['hash'],
+                    extension=blob['extension'],
+                    size=blob['size'],
+                    ref_count=1,
+                )
+                .on_conflict_do_update(
+                    index_elements=[db.Blob.hash],
+                    set_={'ref_count': db.Blob.ref_count + 1},
+                )
+        )
+
+    def release(self, session, blob_hash):
+        session.execute(
+            update(db.Blob)
+                .where(db.Blob.hash == blob_hash)
+                .values(ref_count=db.Blob.ref_count - 1)
+        )
+
+    def collect_garbage(self):
+        """
+        Delete blobs that are no longer referenced, along with any blob
+        files that never made it into the database (such as when saving a
+        dream failed partway through). Returns the number of files deleted.
+
+        A blob that's being stored can look unreferenced until its rows are
+        committed, so this should only run before any dreams get saved.
+        """
+        with db.Session() as session:
+            unreferenced_blobs = session.execute(
+                select(db.Blob.hash, db.Blob.extension).where(db.Blob.ref_count <= 0)
+            ).all()
+            session.execute(delete(db.Blob).where(db.Blob.ref_count <= 0))
+            session.commit()
+
+            known_filenames = {
+                f'{blob_hash}.{extension}'
+                for blob_hash, extension in session.execute(select(db.Blob.hash, db.Blob.extension))
+            }
+
+        num_deleted = 0
+        for blob_hash, extension in unreferenced_blobs:
+            try:
+                os.remove(self.path(blob_hash, extension))
+                num_deleted += 1
+            except FileNotFoundError:
+                pass
+
+        blobs_dir = os.path.join(self.images_dir, BLOBS_DIRNAME)
+        orphan_cutoff = time.time() - ORPHAN_GRACE_SECONDS
+        for dir_path, _, filenames in os.walk(blobs_dir):
+            for filename in filenames:
+                path = os.path.join(dir_path, filename)
+                if filename not in known_filenames and os.path.getmtime(path) < orphan_cutoff:
+                    os.remove(path)
+                    num_deleted += 1
+
+        return num_deleted
@@ -0,0 +1,51 @@
+import asyncio
+
+class DataLoader():
+    """
+    Batches loads of individual keys into a single call to `batch_load`.
+
+    Every `load(key)` made during the same event loop iteration, such as
+    while GraphQL resolves a field for each item in a list, is collected
+    and passed to `batch_load(keys)` at once. `batch_load` is a coroutine
+    that returns one value per key, in the same order. Values are cached for
+    the lifetime of the loader, so loaders should be created per request.
+    """
+
+    def __init__(self, batch_load):
+        self.batch_load = batch_load
+        self.cache = {}
+        self.pending = {}
+
+    def load(self, key):
+        future = self.cache.get(key)
+        if future is not None:
+            return future
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.cache[key] = future
+
+        if len(self.pending) == 0:
+            loop.call_soon(self._dispatch)
+        self.pending[key] = future
+
+        return future
+
+    def _dispatch(self):
+        pending = self.pending
+        self.pending = {}
+        asyncio.create_task(self._load_batch(pending))
+
+    async def _load_batch(self, pending):
+        keys = list(pending.keys())
+        try:
+            values = await self.batch_load(keys)
+        except Exception as error:
+            for key, future in pending.items():
+                # Failed loads can be retried
+                del self.cache[key]
+                future.set_exception(error)
+            return
+
+        for key, value in zip(keys, values):
+            pending[key].set_result(value)
@@ -1,13 +1,28 @@
 import alembic.config
 import alembic.command
 import sqlalchemy
+import sqlalchemy.event
 import sqlalchemy.orm
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, func
+import sqlalchemy.pool
+from sqlalchemy import Column, Index, Integer, String, DateTime, ForeignKey, func
 
 Session = sqlalchemy.orm.sessionmaker()
 
+# Applied to every new connection. WAL lets readers keep reading while a
+# write is in progress, and with WAL a `synchronous` level of NORMAL is
+# still safe against corruption (a power loss can only lose the latest
+# commits)
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,
+}
+
+DEFAULT_POOL_SIZE = 5
+
 class DbConfig():
-    def __init__(self, alembic_ini_path, alembic_script_path, db_path):
+    def __init__(self, alembic_ini_path, alembic_script_path, db_path, pragmas=None, pool_size=DEFAULT_POOL_SIZE):
         # TODO: Support proper URL escaping
         if db_path.count("?") > 0 or db_path.count("%") > 0:
             raise Exception(f"invalid db path: {db_path}")
@@ -16,10 +31,26 @@ class DbConfig():
         self.alembic_script_path = alembic_script_path
         self.db_path = db_path
         self.db_url = f"sqlite:///{db_path}?mode=rwc"
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
 
-        self.db_engine = sqlalchemy.create_engine(self.db_url)
+        # SQLAlchemy doesn't pool file database connections by default.
+        # Connections get handed between threads by the pool, but are only
+        # ever used by one thread at a time
+        self.db_engine = sqlalchemy.create_engine(
+            self.db_url,
+            poolclass=sqlalchemy.pool.QueuePool,
+            pool_size=pool_size,
+            connect_args={'check_same_thread': False},
+        )
+        sqlalchemy.event.listen(self.db_engine, 'connect', self.configure_connection)
         Session.configure(bind=self.db_engine)
 
+    def configure_connection(self, dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        for name, value in self.pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
 def run_db_migrations(db_config, db_conn):
     alembic_cfg = alembic.config.Config(db_config.alembic_ini_path)
     alembic_cfg.attributes['connection'] = db_conn
@@ -40,19 +71,50 @@ class Dream(Base):
     settings_json = Column(String, nullable=False)
     base_image_path = Column(String)
     base_image_mask_path = Column(String)
+    base_image_blob_hash = Column(String)
+    base_image_mask_blob_hash = Column(String)
     created_at = Column(DateTime, nullable=False, server_default=func.current_timestamp())
 
+    __table_args__ = (
+        Index('ix_dreams_created_at', 'created_at', 'id'),
+    )
+
 class DreamImage(Base):
     __tablename__ = 'dream_images'
 
     id = Column(String, primary_key=True)
-    dream_id = Column(String, ForeignKey('dreams.id'), nullable=False)
+    dream_id = Column(String, ForeignKey('dreams.id'), nullable=False, index=True)
     seed = Column(Integer, nullable=False)
     index = Column(Integer, nullable=False)
     image_path = Column(String, nullable=False)
     width = Column(Integer, nullable=False)
     height = Column(Integer, nullable=False)
     blurhash = Column(String, nullable=False)
+    blob_hash = Column(String)
+
+    blob = sqlalchemy.orm.relationship(
+        'Blob',
+        primaryjoin='foreign(DreamImage.blob_hash) == Blob.hash',
+        viewonly=True,
+    )
+
+class DreamImageThumbnail(Base):
+    __tablename__ = 'dream_image_thumbnails'
+
+    dream_image_id = Column(String, ForeignKey('dream_images.id'), primary_key=True)
+    size = Column(Integer, primary_key=True)
+    format = Column(String, nullable=False)
+    image_path = Column(String, nullable=False)
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+
+class Blob(Base):
+    __tablename__ = 'blobs'
+
+    hash = Column(String, primary_key=True)
+    extension = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)
 
 class Settings(Base):
     __tablename__ = 'settings'
@@ -0,0 +1,85 @@
+import asyncio
+from concurrent.futures import Future
+import queue
+import threading
+import db
+
+DEFAULT_MAX_BATCH_SIZE = 64
+
+class DbWriter():
+    """
+    Runs database writes on a single thread, committing every write that
+    queued up while the previous commit was running in one transaction.
+
+    Under load, this turns many small transactions into a few larger ones
+    (a group commit), so the database spends less time syncing and holding
+    its write lock. Writes are functions that take a session and add or
+    change rows without committing.
+    """
+
+    def __init__(self, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        self.max_batch_size = max_batch_size
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, write):
+        """
+        Queue a write, returning a future with the write's return value once
+        it's been committed.
+        """
+        future = Future()
+        self.jobs.put((write, future))
+        return future
+
+    async def write(self, write):
+        return await asyncio.wrap_future(self.submit(write))
+
+    def close(self):
+        # Writes that were already queued still get committed
+        self.jobs.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            batch = [job]
+            closing = False
+            while len(batch) < self.max_batch_size:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+
+                if job is None:
+                    closing = True
+                    break
+
+                batch.append(job)
+
+            self._write_batch(batch)
+
+            if closing:
+                return
+
+    def _write_batch(self, batch):
+        try:
+            with db.Session() as session:
+                results = [write(session) for write, _ in batch]
+                session.commit()
+        except Exception as error:
+            if len(batch) > 1:
+                # Retry each write on its own, so one bad write doesn't fail
+                # the whole batch
+                for job in batch:
+                    self._write_batch([job])
+            else:
+                _, future = batch[0]
+                future.set_exception(error)
+            return
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
@@ -1,5 +1,6 @@
 from ariadne import InterfaceType
 from copy import copy
+from datetime import datetime, timezone
 import json
 from ulid import ULID
 from domain.dream_image import DreamImage
@@ -10,13 +11,33 @@ gql_dream = InterfaceType("Dream")
 def resolve_dream_type(dream, *_):
     return dream.state
 
+@gql_dream.field("images")
+def resolve_dream_images(dream, info):
+    if dream.images is not None:
+        return dream.images
+
+    return load_dream_images(dream, info)
+
+async def load_dream_images(dream, info):
+    # Batched with the images of every other dream resolved in the request
+    db_images = await info.context['dream_images_loader'].load(dream.id)
+    dream.images = [
+        DreamImage.from_db_row(db_image, sampler_steps=dream.sampler_steps)
+        for db_image in db_images
+    ]
+    return dream.images
+
 class Dream():
-    def __init__(self, id, settings):
+    def __init__(self, id, settings, images=None):
         self.id = id
         self.settings = settings
         self.state = 'PendingDream'
-        self.images = []
 
+        if images is not None:
+            self.images = images
+            return
+
+        self.images = []
         for image_index in range(self.num_images):
             dream_image_id = f'di_{ULID()}'
             dream_image = DreamImage(
@@ -27,6 +48,19 @@ class Dream():
             )
             self.images.append(dream_image)
 
+    @classmethod
+    def from_db_row(cls, db_dream):
+        """
+        Build a finished dream from its database row. Its images are left as
+        `None` until they get loaded by `resolve_dream_images`, so listing
+        dreams doesn't query images that aren't requested.
+        """
+        settings = json.loads(db_dream.settings_json)
+        dream = cls(id=db_dream.id, settings=settings, images=[])
+        dream.state = 'FinishedDream'
+        dream.images = None
+        return dream
+
     def is_complete(self):
         return self.state == 'FinishedDream' or self.state == 'StoppedDream'
 
@@ -75,3 +109,15 @@ class Dream():
 
     def num_finished_steps(self, *_):
         return sum(image.num_finished_steps for image in self.images)
+
+    def queue_position(self, info):
+        manager = info.context['manager']
+        return manager.processor.get_queue_position(self.id)
+
+    def estimated_start_time(self, info):
+        manager = info.context['manager']
+        start_time = manager.processor.estimate_start_time(self.id)
+        if start_time is None:
+            return None
+
+        return datetime.fromtimestamp(start_time, tz=timezone.utc).isoformat()
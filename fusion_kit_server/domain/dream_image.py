@@ -6,6 +6,12 @@ gql_dream_image = InterfaceType("DreamImage")
 def resolve_dream_image_type(dream_image, *_):
     return dream_image.state
 
+def image_key_for_db_row(db_image):
+    if db_image.blob is not None:
+        return ('blob', db_image.blob.hash, db_image.blob.extension)
+
+    return (db_image.id, 'image')
+
 class DreamImage():
     def __init__(self, id, dream_id, seed, sampler_steps):
         self.id = id
@@ -13,9 +19,30 @@ class DreamImage():
         self.dream_id = dream_id
         self.state = 'PendingDreamImage'
         self.image_key = None
+        self.preview = None
         self.num_finished_steps = 0
         self.num_total_steps = sampler_steps
 
+        # Known up front for persisted images, otherwise read from the image
+        self.dimensions = None
+
+    @classmethod
+    def from_db_row(cls, db_image, sampler_steps):
+        dream_image = cls(
+            id=db_image.id,
+            dream_id=db_image.dream_id,
+            seed=db_image.seed,
+            sampler_steps=sampler_steps,
+        )
+        dream_image.complete()
+        dream_image.image_key = image_key_for_db_row(db_image)
+        dream_image.dimensions = {
+            'width': db_image.width,
+            'height': db_image.height,
+        }
+
+        return dream_image
+
     def complete(self):
         self.state = 'FinishedDreamImage'
         self.num_finished_steps = self.num_total_steps
@@ -23,28 +50,49 @@ class DreamImage():
     def is_complete(self):
         return self.state == 'FinishedDreamImage'
 
+    def get_dimensions(self, manager):
+        if self.dimensions is not None:
+            return self.dimensions
+
+        return manager.get_image_dimensions(self.image_key)
+
     ### GraphQL resolvers ###
 
     def width(self, info):
         manager = info.context['manager']
-        return manager.get_image_dimensions(self.image_key)['width']
+        return self.get_dimensions(manager)['width']
 
     def height(self, info):
         manager = info.context['manager']
-        return manager.get_image_dimensions(self.image_key)['height']
+        return self.get_dimensions(manager)['height']
 
     def image_path(self, info):
         manager = info.context['manager']
         return manager.get_image_uri(self.image_key)
 
-    def preview_width(self, info):
-        manager = info.context['manager']
-        return manager.get_image_dimensions(self.image_key)['width']
+    def preview_width(self, *_):
+        if self.preview is None:
+            return None
 
-    def preview_height(self, info):
-        manager = info.context['manager']
-        return manager.get_image_dimensions(self.image_key)['height']
+        return self.preview['width']
+
+    def preview_height(self, *_):
+        if self.preview is None:
+            return None
+
+        return self.preview['height']
 
     def preview_image_path(self, info):
         manager = info.context['manager']
-        return manager.get_image_uri(self.image_key)
+        return manager.get_preview_uri(self.preview)
+
+    async def thumbnail_path(self, info, size):
+        if not self.is_complete():
+            return None
+
+        # Batched with the thumbnails of every other image resolved in the
+        # request
+        db_thumbnails = await info.context['thumbnails_loader'].load(self.id)
+
+        manager = info.context['manager']
+        return manager.get_thumbnail_uri(self.id, db_thumbnails, size)
@@ -1,4 +1,5 @@
 from ariadne import ObjectType, SubscriptionType, make_executable_schema, convert_kwargs_to_snake_case, snake_case_fallback_resolvers, upload_scalar
+from dataloader import DataLoader
 from domain.dream import gql_dream
 from domain.dream_image import gql_dream_image
 from domain.downloader import gql_model_download
@@ -17,6 +18,24 @@ def resolve_settings(_, info):
 
     return manager.settings
 
+@query.field("dream")
+async def resolve_dream(_, info, id):
+    manager = info.context['manager']
+
+    return await manager.get_dream(id)
+
+@query.field("dreams")
+async def resolve_dreams(_, info, first=None, after=None, prompt=None):
+    manager = info.context['manager']
+
+    return await manager.list_dreams(first=first, after=after, prompt=prompt)
+
+@query.field("searchDreams")
+async def resolve_search_dreams(_, info, query, first=None, after=None):
+    manager = info.context['manager']
+
+    return await manager.search_dreams(query=query, first=first, after=after)
+
 mutation = ObjectType("Mutation")
 
 @mutation.field("startDream")
@@ -27,26 +46,45 @@ async def resolve_start_dream(_, info, options):
     dream = await manager.start_dream(options)
     return dream
 
+@mutation.field("cancelDream")
+@convert_kwargs_to_snake_case
+async def resolve_cancel_dream(_, info, dream_id):
+    manager = info.context['manager']
+
+    dream = await manager.cancel_dream(dream_id)
+    return dream
+
+@mutation.field("deleteDream")
+@convert_kwargs_to_snake_case
+async def resolve_delete_dream(_, info, dream_id):
+    manager = info.context['manager']
+
+    return await manager.delete_dream(dream_id)
+
 @mutation.field("updateSettings")
 @convert_kwargs_to_snake_case
 async def resolve_update_settings(_, info, new_settings):
     manager = info.context['manager']
 
-    manager.update_settings(new_settings)
+    await manager.update_settings(new_settings)
     return manager.settings
 
 subscription = SubscriptionType()
 
 @subscription.source("watchDream")
 @convert_kwargs_to_snake_case
-async def watch_dream_generator(obj, info, dream_id):
+async def watch_dream_generator(obj, info, dream_id, max_updates_per_second=None):
     manager = info.context['manager']
-    async for dream_state in manager.watch_dream(dream_id = dream_id):
+    watch_dream = manager.watch_dream(
+        dream_id = dream_id,
+        max_updates_per_second = max_updates_per_second,
+    )
+    async for dream_state in watch_dream:
         yield dream_state
 
 @subscription.field("watchDream")
 @convert_kwargs_to_snake_case
-async def watch_dream_resolver(dream_state, info, dream_id):
+async def watch_dream_resolver(dream_state, info, dream_id, max_updates_per_second=None):
     return dream_state
 
 @subscription.source("downloadModel")
@@ -92,11 +130,14 @@ def make_schema(type_defs):
         query,
         mutation,
         subscription,
-        snake_case_fallback_resolvers,
         upload_scalar,
+        # Interface field resolvers (like `Dream.images`) only get copied to
+        # fields of the implementing types that don't have a resolver yet, so
+        # they have to be bound before the fallback resolvers
         gql_dream,
         gql_dream_image,
         gql_model_download,
+        snake_case_fallback_resolvers,
     )
 
 def context_builder(manager):
@@ -104,5 +145,7 @@ def context_builder(manager):
         return {
             'request': request,
             'manager': manager,
+            'dream_images_loader': DataLoader(manager.repository.get_dream_images),
+            'thumbnails_loader': DataLoader(manager.repository.get_dream_image_thumbnails),
         }
     return make_context
@@ -3,9 +3,17 @@ import re
 from ariadne import ObjectType
 import torch.cuda
 
-def get_available_devices():
+def get_available_devices(pool_devices=None):
+    """
+    Return the devices dreams can run on, mapped to how strongly each one is
+    preferred. The CPU is only included when the runner pool was started
+    with CPU runners (`pool_devices` are the devices from `--devices`).
+    """
     available_devices = {}
 
+    if pool_devices is not None and 'cpu' in pool_devices:
+        available_devices['cpu'] = 0
+
     if torch.cuda.is_available():
         available_devices['cuda'] = 20
 
@@ -17,8 +25,8 @@ def get_available_devices():
 
     return available_devices
 
-def get_default_device():
-    devices = get_available_devices()
+def get_default_device(pool_devices=None):
+    devices = get_available_devices(pool_devices)
 
     sorted_devices = sorted(devices.items(), key=lambda pair: pair[1])
     if len(sorted_devices) > 0:
@@ -29,6 +37,14 @@ def get_default_device():
 # Don't allow path separators in filenames (avoids path traversal issues)
 FILENAME_REGEX = r'\A[^/\\]*\Z'
 
+DEFAULT_MAX_BATCH_SIZE = 1
+
+PREVIEW_MODES = ('FULL', 'APPROXIMATE')
+
+DEFAULT_PREVIEW_MODE = 'FULL'
+
+DEFAULT_PREVIEW_MAX_EDGE = 256
+
 class Settings():
     def __init__(
         self,
@@ -37,14 +53,20 @@ class Settings():
         use_full_precision,
         show_previews,
         steps_per_preview,
+        max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+        preview_mode=DEFAULT_PREVIEW_MODE,
+        preview_max_edge=DEFAULT_PREVIEW_MAX_EDGE,
     ):
         self.models = models
         self.device = device
         self.use_full_precision = use_full_precision
         self.show_previews = show_previews
         self.steps_per_preview = steps_per_preview
+        self.max_batch_size = max_batch_size
+        self.preview_mode = preview_mode
+        self.preview_max_edge = preview_max_edge
 
-    def validate(self, data_dir):
+    def validate(self, data_dir, pool_devices=None):
         errors = []
 
         active_models = [model for model in self.models if model['is_active']]
@@ -56,11 +78,21 @@ class Settings():
         for model in self.models:
             errors += self._validate_model(model, data_dir)
 
-        if get_default_device() == '':
+        available_devices = get_available_devices(pool_devices)
+        if len(available_devices) == 0:
             errors.append(f'no active devices found (only Nvidia GPUs and Apple Silicon are currently supported)')
-        elif self.device not in get_available_devices():
+        elif self.device not in available_devices:
             errors.append(f'unsupported device: {self.device}')
 
+        if self.max_batch_size < 1:
+            errors.append(f'invalid max batch size: {self.max_batch_size}')
+
+        if self.preview_mode not in PREVIEW_MODES:
+            errors.append(f'invalid preview mode: {self.preview_mode}')
+
+        if self.preview_max_edge < 1:
+            errors.append(f'invalid preview max edge: {self.preview_max_edge}')
+
         return errors
 
     def _validate_model(self, model, data_dir):
@@ -91,13 +123,16 @@ class Settings():
             'use_full_precision': self.use_full_precision,
             'show_previews': self.show_previews,
             'steps_per_preview': self.steps_per_preview,
+            'max_batch_size': self.max_batch_size,
+            'preview_mode': self.preview_mode,
+            'preview_max_edge': self.preview_max_edge,
         }
 
     @staticmethod
-    def get_default_settings():
+    def get_default_settings(pool_devices=None):
         return Settings(
             models=[],
-            device=get_default_device(),
+            device=get_default_device(pool_devices),
             use_full_precision=False,
             show_previews=True,
             steps_per_preview=10,
@@ -111,6 +146,9 @@ class Settings():
             use_full_precision=json['use_full_precision'],
             show_previews=json['show_previews'],
             steps_per_preview=json['steps_per_preview'],
+            max_batch_size=json.get('max_batch_size', DEFAULT_MAX_BATCH_SIZE),
+            preview_mode=json.get('preview_mode', DEFAULT_PREVIEW_MODE),
+            preview_max_edge=json.get('preview_max_edge', DEFAULT_PREVIEW_MAX_EDGE),
         )
 
     ### GraphQL resolvers ###
@@ -125,10 +163,11 @@ class Settings():
     def is_ready(self, info):
         manager = info.context['manager']
 
-        return len(self.validate(manager.data_dir)) == 0
+        return len(self.validate(manager.data_dir, pool_devices=manager.devices)) == 0
 
-    def available_devices(self, *_):
-        devices = get_available_devices()
+    def available_devices(self, info):
+        manager = info.context['manager']
+        devices = get_available_devices(manager.devices)
 
         sorted_devices = sorted(devices.items(), key=lambda pair: pair[1])
         return [pair[0] for pair in reversed(sorted_devices)]
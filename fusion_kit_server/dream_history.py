@@ -0,0 +1,242 @@
+import base64
+import json
+from sqlalchemy import String, delete, select, text, tuple_, type_coerce
+from sqlalchemy.orm import joinedload
+import db
+from domain.dream import Dream
+from domain.dream_image import image_key_for_db_row
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+class InvalidCursorError(Exception):
+    def __init__(self, cursor):
+        super().__init__(f"Invalid cursor: {cursor}")
+        self.cursor = cursor
+
+# Compare `created_at` as the string SQLite stores, so cursors round-trip
+# exactly regardless of how SQLAlchemy would format a datetime
+created_at_key = type_coerce(db.Dream.created_at, String)
+
+def encode_cursor(*values):
+    cursor_json = json.dumps(values)
+    return base64.urlsafe_b64encode(cursor_json.encode()).decode()
+
+def decode_cursor(cursor, value_types):
+    """
+    Decode a cursor from `encode_cursor`, checking that it holds one value of
+    each type in `value_types`.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise InvalidCursorError(cursor)
+
+    if not isinstance(values, list) or len(values) != len(value_types):
+        raise InvalidCursorError(cursor)
+    if not all(isinstance(value, value_type) for value, value_type in zip(values, value_types)):
+        raise InvalidCursorError(cursor)
+
+    return values
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def validate_page_size(first):
+    if first is None:
+        return DEFAULT_PAGE_SIZE
+    if first < 0 or first > MAX_PAGE_SIZE:
+        raise Exception(f"first must be between 0 and {MAX_PAGE_SIZE}")
+
+    return first
+
+def list_dreams(first=None, after=None, prompt=None):
+    """
+    Return a page of persisted dreams, newest first.
+
+    Pages are paginated by `(created_at, id)` rather than by offset, so each
+    page is a range scan over the `ix_dreams_created_at` index no matter how
+    deep into the history it is. `prompt` filters dreams to ones whose
+    prompt contains it (case-insensitive).
+    """
+    first = validate_page_size(first)
+
+    query = (
+        select(db.Dream, created_at_key.label('created_at_key'))
+            .order_by(db.Dream.created_at.desc(), db.Dream.id.desc())
+            .limit(first + 1)
+    )
+
+    if after is not None:
+        after_created_at, after_id = decode_cursor(after, value_types=(str, str))
+        query = query.where(tuple_(created_at_key, db.Dream.id) < tuple_(after_created_at, after_id))
+
+    if prompt is not None and prompt != '':
+        query = query.where(db.Dream.prompt.like(f'%{escape_like(prompt)}%', escape='\\'))
+
+    with db.Session() as session:
+        rows = session.execute(query).all()
+        has_next_page = len(rows) > first
+        rows = rows[:first]
+
+        dreams = [Dream.from_db_row(db_dream) for db_dream, _ in rows]
+
+    end_cursor = None
+    if len(rows) > 0:
+        db_dream, created_at = rows[-1]
+        end_cursor = encode_cursor(created_at, db_dream.id)
+
+    return {
+        'nodes': dreams,
+        'page_info': {
+            'has_next_page': has_next_page,
+            'end_cursor': end_cursor,
+        },
+    }
+
+def search_query(query):
+    """
+    Turn a user's search into an FTS5 query that matches dreams with every
+    term in their prompt. Terms are quoted so FTS5 syntax is matched
+    literally, and the last term matches as a prefix so results show up
+    while the user is still typing. Returns `None` if there's nothing to
+    search for.
+    """
+    terms = [term.replace('"', '') for term in query.split()]
+    terms = [f'"{term}"' for term in terms if term != '']
+    if len(terms) == 0:
+        return None
+
+    terms[-1] = f'{terms[-1]}*'
+    return ' '.join(terms)
+
+def search_dreams(query, first=None, after=None):
+    """
+    Return a page of persisted dreams whose prompt matches `query`, best
+    matches first.
+
+    Matching uses the `dreams_fts` full-text index, ranked by BM25. Since the
+    ranking isn't stable across inserts, pages are paginated by offset.
+    """
+    first = validate_page_size(first)
+    offset = 0
+    if after is not None:
+        offset, = decode_cursor(after, value_types=(int,))
+
+    match = search_query(query)
+    if match is None:
+        return {
+            'nodes': [],
+            'page_info': {
+                'has_next_page': False,
+                'end_cursor': None,
+            },
+        }
+
+    with db.Session() as session:
+        dream_ids = session.execute(
+            text("""
+                SELECT dream_id FROM dreams_fts
+                WHERE dreams_fts MATCH :match
+                ORDER BY rank, dream_id DESC
+                LIMIT :limit OFFSET :offset
+            """),
+            {'match': match, 'limit': first + 1, 'offset': offset},
+        ).scalars().all()
+        has_next_page = len(dream_ids) > first
+        dream_ids = dream_ids[:first]
+
+        db_dreams = session.execute(
+            select(db.Dream).where(db.Dream.id.in_(dream_ids))
+        ).scalars()
+        db_dreams_by_id = {db_dream.id: db_dream for db_dream in db_dreams}
+        dreams = [Dream.from_db_row(db_dreams_by_id[dream_id]) for dream_id in dream_ids]
+
+    end_cursor = None
+    if len(dreams) > 0:
+        end_cursor = encode_cursor(offset + len(dreams))
+
+    return {
+        'nodes': dreams,
+        'page_info': {
+            'has_next_page': has_next_page,
+            'end_cursor': end_cursor,
+        },
+    }
+
+def get_dream(dream_id):
+    """
+    Return a persisted dream, or `None` if there isn't one with the ID.
+    """
+    with db.Session() as session:
+        db_dream = session.get(db.Dream, dream_id)
+        if db_dream is None:
+            return None
+
+        return Dream.from_db_row(db_dream)
+
+def delete_dream_rows(session, blob_store, dream_id):
+    """
+    Delete a persisted dream along with its images and thumbnails, and
+    release the blobs they used. Returns the IDs of the dream's images, or
+    `None` if there isn't a dream with the ID.
+    """
+    db_dream = session.get(db.Dream, dream_id)
+    if db_dream is None:
+        return None
+
+    db_images = session.execute(
+        select(db.DreamImage).where(db.DreamImage.dream_id == dream_id)
+    ).scalars().all()
+    dream_image_ids = [db_image.id for db_image in db_images]
+
+    blob_hashes = [
+        db_dream.base_image_blob_hash,
+        db_dream.base_image_mask_blob_hash,
+        *(db_image.blob_hash for db_image in db_images),
+    ]
+    for blob_hash in blob_hashes:
+        if blob_hash is not None:
+            blob_store.release(session, blob_hash)
+
+    session.execute(
+        delete(db.DreamImageThumbnail)
+            .where(db.DreamImageThumbnail.dream_image_id.in_(dream_image_ids))
+    )
+    session.execute(delete(db.DreamImage).where(db.DreamImage.dream_id == dream_id))
+    session.execute(delete(db.Dream).where(db.Dream.id == dream_id))
+
+    return dream_image_ids
+
+def get_dream_image_key(dream_image_id):
+    """
+    Return the image key of a persisted dream image, or `None` if there
+    isn't one with the ID.
+    """
+    with db.Session() as session:
+        db_image = session.get(db.DreamImage, dream_image_id, options=[joinedload(db.DreamImage.blob)])
+        if db_image is None:
+            return None
+
+        return image_key_for_db_row(db_image)
+
+def get_dream_images(dream_ids):
+    """
+    Return the image rows of each dream in `dream_ids` with a single query,
+    as a list of rows (ordered by index) for each dream.
+    """
+    db_images_by_dream_id = {dream_id: [] for dream_id in dream_ids}
+    if len(dream_ids) == 0:
+        return []
+
+    with db.Session() as session:
+        db_images = session.execute(
+            select(db.DreamImage)
+                .options(joinedload(db.DreamImage.blob))
+                .where(db.DreamImage.dream_id.in_(db_images_by_dream_id.keys()))
+                .order_by(db.DreamImage.dream_id, db.DreamImage.index)
+        ).scalars()
+        for db_image in db_images:
+            db_images_by_dream_id[db_image.dream_id].append(db_image)
+
+    return [db_images_by_dream_id[dream_id] for dream_id in dream_ids]
@@ -0,0 +1,102 @@
+from functools import lru_cache
+import math
+import numpy
+from PIL import Image
+
+# BlurHash only keeps a handful of low-frequency components, so computing it
+# from a small thumbnail gives a visually equivalent hash for a fraction of
+# the work of using the full-resolution image
+THUMBNAIL_SIZE = (32, 32)
+
+DEFAULT_X_COMPONENTS = 4
+DEFAULT_Y_COMPONENTS = 4
+
+BASE83_CHARACTERS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+def _make_srgb_to_linear_table():
+    values = numpy.arange(256, dtype=numpy.float32) / 255
+    return numpy.where(
+        values <= 0.04045,
+        values / 12.92,
+        ((values + 0.055) / 1.055) ** 2.4,
+    ).astype(numpy.float32)
+
+SRGB_TO_LINEAR = _make_srgb_to_linear_table()
+
+def linear_to_srgb(value):
+    value = min(max(value, 0.0), 1.0)
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    else:
+        return int((1.055 * math.pow(value, 1 / 2.4) - 0.055) * 255 + 0.5)
+
+def encode_base83(value, length):
+    return ''.join(
+        BASE83_CHARACTERS[(value // (83 ** (length - index - 1))) % 83]
+        for index in range(length)
+    )
+
+@lru_cache(maxsize=None)
+def cosine_basis(width, height, x_components, y_components):
+    xs = numpy.arange(width, dtype=numpy.float32)
+    ys = numpy.arange(height, dtype=numpy.float32)
+    x_freqs = numpy.arange(x_components, dtype=numpy.float32)
+    y_freqs = numpy.arange(y_components, dtype=numpy.float32)
+
+    basis_x = numpy.cos(numpy.pi * x_freqs[:, None] * xs[None, :] / width)
+    basis_y = numpy.cos(numpy.pi * y_freqs[:, None] * ys[None, :] / height)
+
+    normalization = numpy.full((y_components, x_components), 2 / (width * height), dtype=numpy.float32)
+    normalization[0, 0] = 1 / (width * height)
+
+    return basis_x, basis_y, normalization
+
+def encode(image, x_components=DEFAULT_X_COMPONENTS, y_components=DEFAULT_Y_COMPONENTS):
+    """
+    Compute the BlurHash of a PIL image.
+    """
+    thumbnail = image.convert('RGB').resize(THUMBNAIL_SIZE, resample=Image.BOX)
+    pixels = SRGB_TO_LINEAR[numpy.asarray(thumbnail)]
+    height, width, _ = pixels.shape
+
+    basis_x, basis_y, normalization = cosine_basis(width, height, x_components, y_components)
+
+    # Factors are ordered row-major by (y component, x component), with the
+    # DC component first
+    factors = numpy.einsum('jy,ix,yxc->jic', basis_y, basis_x, pixels)
+    factors = (factors * normalization[:, :, None]).reshape(-1, 3)
+
+    dc = factors[0]
+    ac = factors[1:]
+
+    blurhash = encode_base83((x_components - 1) + (y_components - 1) * 9, 1)
+
+    if len(ac) > 0:
+        actual_max = float(numpy.abs(ac).max())
+        quantized_max = int(max(0, min(82, math.floor(actual_max * 166 - 0.5))))
+        max_value = (quantized_max + 1) / 166
+        blurhash += encode_base83(quantized_max, 1)
+    else:
+        max_value = 1
+        blurhash += encode_base83(0, 1)
+
+    dc_value = (linear_to_srgb(dc[0]) << 16) + (linear_to_srgb(dc[1]) << 8) + linear_to_srgb(dc[2])
+    blurhash += encode_base83(dc_value, 4)
+
+    scaled_ac = ac / max_value
+    quantized_ac = numpy.clip(
+        numpy.floor(numpy.sign(scaled_ac) * numpy.sqrt(numpy.abs(scaled_ac)) * 9 + 9.5),
+        0,
+        18,
+    ).astype(numpy.int64)
+    for r, g, b in quantized_ac:
+        blurhash += encode_base83(int(r) * 19 * 19 + int(g) * 19 + int(b), 2)
+
+    return blurhash
+
+def warm_up():
+    """
+    Precompute the cosine basis used for thumbnails, so the first dream
+    doesn't pay for it.
+    """
+    encode(Image.new('RGB', THUMBNAIL_SIZE))
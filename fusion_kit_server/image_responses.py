@@ -0,0 +1,137 @@
+import hashlib
+import os
+from starlette.responses import FileResponse, Response
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+class RangeNotSatisfiableError(Exception):
+    pass
+
+def file_etag(path, stat_result):
+    # Persisted images are written once and never modified, so the path,
+    # size and mtime identify the contents
+    file_id = f"{path}:{stat_result.st_size}:{stat_result.st_mtime_ns}"
+    return f'"{hashlib.blake2b(file_id.encode(), digest_size=16).hexdigest()}"'
+
+def etag_matches(header, etag):
+    if header is None:
+        return False
+
+    if header.strip() == '*':
+        return True
+
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+
+    return False
+
+def parse_range(header, size):
+    """
+    Parse a `Range` header into an inclusive `(start, end)` tuple. Returns
+    `None` if the whole body should be sent instead, which is the case for
+    missing, malformed or multi-part ranges.
+    """
+    if header is None or not header.startswith('bytes='):
+        return None
+
+    spec = header[len('bytes='):].strip()
+    if ',' in spec:
+        return None
+
+    start, separator, end = spec.partition('-')
+    if separator != '-':
+        return None
+
+    try:
+        if start == '':
+            suffix_length = int(end)
+            if suffix_length <= 0:
+                raise RangeNotSatisfiableError()
+            return (max(0, size - suffix_length), size - 1)
+
+        start = int(start)
+        end = int(end) if end != '' else size - 1
+    except ValueError:
+        return None
+
+    if start > end:
+        return None
+
+    if start >= size:
+        raise RangeNotSatisfiableError()
+
+    return (start, min(end, size - 1))
+
+def image_response(request, etag, size, media_type, immutable, read_range, full_response):
+    headers = {
+        'etag': etag,
+        'cache-control': IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL,
+        'accept-ranges': 'bytes',
+    }
+
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    if_range = request.headers.get('if-range')
+    if if_range is None or if_range.strip() == etag:
+        try:
+            byte_range = parse_range(request.headers.get('range'), size)
+        except RangeNotSatisfiableError:
+            headers['content-range'] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+
+    if byte_range is None:
+        return full_response(headers)
+
+    start, end = byte_range
+    headers['content-range'] = f"bytes {start}-{end}/{size}"
+    return Response(
+        read_range(start, end + 1),
+        status_code=206,
+        media_type=media_type,
+        headers=headers,
+    )
+
+def bytes_image_response(request, data, etag, media_type, immutable):
+    return image_response(
+        request,
+        etag=etag,
+        size=len(data),
+        media_type=media_type,
+        immutable=immutable,
+        read_range=lambda start, end: data[start:end],
+        full_response=lambda headers: Response(data, media_type=media_type, headers=headers),
+    )
+
+def file_image_response(request, path, media_type, immutable):
+    stat_result = os.stat(path)
+
+    def read_range(start, end):
+        with open(path, 'rb') as file:
+            file.seek(start)
+            return file.read(end - start)
+
+    def full_response(headers):
+        # `FileResponse` lets the server use zero-copy sends when supported
+        return FileResponse(
+            path,
+            media_type=media_type,
+            headers=headers,
+            stat_result=stat_result,
+        )
+
+    return image_response(
+        request,
+        etag=file_etag(path, stat_result),
+        size=stat_result.st_size,
+        media_type=media_type,
+        immutable=immutable,
+        read_range=read_range,
+        full_response=full_response,
+    )
@@ -0,0 +1,181 @@
+from collections import OrderedDict
+import hashlib
+from io import BytesIO
+import os
+import threading
+from PIL import Image
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+class ImageNotFoundError(Exception):
+    def __init__(self, key):
+        super().__init__(f"Image not found: {key}")
+        self.key = key
+
+def decoded_image_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+def encode_png(image):
+    data = BytesIO()
+    image.save(data, format='png')
+    return data.getvalue()
+
+def content_etag(data):
+    return f'"{hashlib.blake2b(data, digest_size=16).hexdigest()}"'
+
+class ImageStore():
+    """
+    An in-memory store of decoded images with a byte budget.
+
+    Images are evicted in least-recently-used order once the store grows past
+    `max_bytes`. Final images are pinned until they have been persisted to
+    disk, after which they can be evicted and will be re-loaded from
+    `persisted_path(key)` on demand. Previews are kept separately, in
+    `PreviewCache`.
+
+    Each image is PNG-encoded at most once while it stays in memory; the
+    encoded bytes count towards the same budget as the decoded image.
+
+    Keys are tuples of `(dream_image_id, image_key)`.
+    """
+
+    def __init__(self, max_bytes, persisted_path):
+        self.max_bytes = max_bytes
+        self.persisted_path = persisted_path
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+    def register(self, key, image):
+        with self.lock:
+            if key in self.entries:
+                return
+
+            self._insert(key, image, pinned=True)
+            self._evict()
+
+    def mark_persisted(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry['pinned'] = False
+
+                # Persisted images get served from disk, so the encoded
+                # bytes aren't needed anymore
+                self._drop_encoded(entry)
+            self._evict()
+
+    def unpin(self, key):
+        """
+        Let an image be evicted even though it hasn't been persisted, such as
+        when persisting it failed. Once evicted, it's gone for good.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry['pinned'] = False
+            self._evict()
+
+    def contains(self, key):
+        with self.lock:
+            if key in self.entries:
+                return True
+
+        path = self.persisted_path(key)
+        return path is not None and os.path.isfile(path)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry['image']
+
+        path = self.persisted_path(key)
+        if path is None or not os.path.isfile(path):
+            raise ImageNotFoundError(key)
+
+        image = Image.open(path)
+        image.load()
+
+        with self.lock:
+            if key not in self.entries:
+                self._insert(key, image, pinned=False)
+                self._evict()
+
+        return image
+
+    def get_encoded(self, key):
+        """
+        Return a tuple of `(png_bytes, etag)` for the image, encoding it
+        if it hasn't been encoded yet.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['encoded'] is not None:
+                self.entries.move_to_end(key)
+                return entry['encoded'], entry['etag']
+
+        image = self.get(key)
+        data = encode_png(image)
+        etag = content_etag(data)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['encoded'] is None:
+                entry['encoded'] = data
+                entry['etag'] = etag
+                entry['size'] += len(data)
+                self.total_bytes += len(data)
+                self._evict()
+
+        return data, etag
+
+    def get_dimensions(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry['image'].size
+
+        path = self.persisted_path(key)
+        if path is None or not os.path.isfile(path):
+            raise ImageNotFoundError(key)
+
+        # Opening an image only reads its header, so this avoids decoding
+        # evicted images just to get their dimensions
+        with Image.open(path) as image:
+            return image.size
+
+    def _insert(self, key, image, pinned):
+        size = decoded_image_bytes(image)
+        self.entries[key] = {
+            'image': image,
+            'encoded': None,
+            'etag': None,
+            'size': size,
+            'pinned': pinned,
+        }
+        self.total_bytes += size
+
+    def _drop_encoded(self, entry):
+        if entry['encoded'] is not None:
+            entry['size'] -= len(entry['encoded'])
+            self.total_bytes -= len(entry['encoded'])
+            entry['encoded'] = None
+            entry['etag'] = None
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry['size']
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        evictable_keys = [key for key, entry in self.entries.items() if not entry['pinned']]
+        for key in evictable_keys:
+            if self.total_bytes <= self.max_bytes:
+                break
+
+            self._remove(key)
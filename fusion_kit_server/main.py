@@ -1,5 +1,4 @@
 import argparse
-from io import BytesIO
 import os
 import sys
 import multiprocessing
@@ -15,13 +14,22 @@ from packaging import version
 from starlette.applications import Starlette
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import StreamingResponse
+from starlette.responses import Response
 from starlette.routing import Route, WebSocketRoute, Mount
 from starlette.staticfiles import StaticFiles
 import uvicorn
 import domain.graphql
 import domain.versions
+import image_responses
+import image_store
+import preview_cache
+import processor
+import thumbnails
+import uploads
+from image_store import ImageNotFoundError
+from db_writer import DbWriter
 from manager import FusionKitManager
+from repository import Repository
 
 if getattr(sys, 'frozen', False):
     # Fix multiprocessing infinite loop
@@ -65,21 +73,116 @@ db_config = db.DbConfig(
 
 def get_image(request):
     manager = request.app.state.manager
-    image = manager.get_image_by_path(f"/images/{request.path_params['image_path']}")
 
-    data = BytesIO()
-    image.save(data, format='png')
-    data.seek(0)
-    return StreamingResponse(data, media_type='image/png')
+    try:
+        image_key = manager.get_image_key_by_path(f"/images/{request.path_params['image_path']}")
+    except ImageNotFoundError:
+        return Response(status_code=404)
+
+    image_file = manager.get_persisted_image_file(image_key)
+    if image_file is None:
+        try:
+            data, etag = manager.get_encoded_image(image_key)
+            return image_responses.bytes_image_response(
+                request,
+                data=data,
+                etag=etag,
+                media_type='image/png',
+                immutable=True,
+            )
+        except ImageNotFoundError:
+            pass
+
+        # The image could have been persisted and evicted from memory since
+        # its URI was handed out
+        image_key = manager.find_persisted_image_key(image_key)
+        if image_key is not None:
+            image_file = manager.get_persisted_image_file(image_key)
+
+    if image_file is None:
+        return Response(status_code=404)
+
+    return image_responses.file_image_response(
+        request,
+        path=image_file,
+        media_type=manager.get_image_media_type(image_key),
+        immutable=True,
+    )
+
+def get_thumbnail(request):
+    manager = request.app.state.manager
+
+    thumbnail_file = manager.get_thumbnail_file(
+        dream_image_id=request.path_params['dream_image_id'],
+        filename=request.path_params['filename'],
+    )
+    if thumbnail_file is None:
+        return Response(status_code=404)
+
+    _, thumbnail_format = thumbnails.parse_thumbnail_filename(request.path_params['filename'])
+    return image_responses.file_image_response(
+        request,
+        path=thumbnail_file,
+        media_type=thumbnails.THUMBNAIL_MEDIA_TYPES[thumbnail_format],
+        immutable=True,
+    )
+
+async def get_preview(request):
+    # Previews are served from memory, so this runs on the event loop
+    # alongside the preview cache instead of in a thread
+    manager = request.app.state.manager
+
+    preview = manager.get_preview(
+        dream_image_id=request.path_params['dream_image_id'],
+        filename=request.path_params['filename'],
+    )
+    if preview is None:
+        return Response(status_code=404)
+
+    return image_responses.bytes_image_response(
+        request,
+        data=preview['data'],
+        etag=preview['etag'],
+        media_type=preview_cache.PREVIEW_MEDIA_TYPES[preview['format']],
+        immutable=True,
+    )
+
+async def backfill_thumbnails(thumbnail_sizes):
+    db_writer = DbWriter()
+    repository = Repository(db_config=db_config, db_writer=db_writer)
+    try:
+        await repository.run_migrations()
+        num_thumbnails = await thumbnails.backfill_thumbnails(
+            repository=repository,
+            db_writer=db_writer,
+            images_dir=images_dir,
+            sizes=thumbnail_sizes,
+        )
+        print(f"done, created {num_thumbnails} thumbnail(s)")
+    finally:
+        db_writer.close()
+        repository.close()
 
 parser = argparse.ArgumentParser(description='FusionKit server')
 parser.add_argument('-p', '--port', default=2424, help='server port')
 parser.add_argument('-a', '--address', default='127.0.0.1', help='server address')
 parser.add_argument('--cors', default='*', help='comma-separated list of origins to allow for API access')
+parser.add_argument('--image-cache-mb', type=int, default=image_store.DEFAULT_MAX_BYTES // (1024 * 1024), help='maximum size of decoded images to keep in memory (in MiB)')
+parser.add_argument('--devices', default=None, help='comma-separated list of devices to run a runner process on, e.g. "cuda:0,cuda:1" or "cpu,cpu" (defaults to one runner on the device from the settings)')
+parser.add_argument('--warm-standby', action='store_true', help='keep a second runner process with the model loaded, to take over immediately if the main runner dies')
+parser.add_argument('--thumbnail-sizes', type=thumbnails.parse_thumbnail_sizes, default=list(thumbnails.DEFAULT_THUMBNAIL_SIZES), help='comma-separated list of thumbnail sizes to create for saved images (in pixels)')
+parser.add_argument('--backfill-thumbnails', action='store_true', help='create any missing thumbnails for previously saved images, then exit')
+parser.add_argument('--max-upload-mb', type=int, default=uploads.DEFAULT_MAX_BYTES // (1024 * 1024), help='maximum file size of uploaded base images (in MiB)')
+parser.add_argument('--max-upload-megapixels', type=float, default=uploads.DEFAULT_MAX_PIXELS / 1000000, help='maximum resolution of uploaded base images (in megapixels)')
+parser.add_argument('--max-dream-attempts', type=int, default=processor.DEFAULT_MAX_REQUEST_ATTEMPTS, help='how many times to try running a dream if the runner process dies')
 
 async def main():
     args = parser.parse_args()
 
+    if args.backfill_thumbnails:
+        await backfill_thumbnails(thumbnail_sizes=args.thumbnail_sizes)
+        return
+
     # Spawn is required when CUDA is initialized in the parent process
     multiprocessing.set_start_method('spawn')
 
@@ -92,7 +195,20 @@ async def main():
         print('========================================')
         print()
 
-    async with FusionKitManager(db_config=db_config, data_dir=data_dir) as manager:
+    max_upload_bytes = args.max_upload_mb * 1024 * 1024
+
+    manager = FusionKitManager(
+        db_config=db_config,
+        data_dir=data_dir,
+        image_cache_bytes=args.image_cache_mb * 1024 * 1024,
+        devices=args.devices.split(',') if args.devices is not None else None,
+        warm_standby=args.warm_standby,
+        max_request_attempts=args.max_dream_attempts,
+        thumbnail_sizes=args.thumbnail_sizes,
+        max_upload_bytes=max_upload_bytes,
+        max_upload_pixels=int(args.max_upload_megapixels * 1000000),
+    )
+    async with manager:
         context_builder = domain.graphql.context_builder(manager)
 
         schema = domain.graphql.make_schema(type_defs)
@@ -108,6 +224,8 @@ async def main():
             Route("/graphql", graphql_app, methods=["GET", "POST"]),
             WebSocketRoute("/graphql", endpoint=graphql_app),
             Route("/images/{image_path:path}", get_image, methods=["GET"]),
+            Route("/thumbnails/{dream_image_id}/{filename}", get_thumbnail, methods=["GET"]),
+            Route("/previews/{dream_image_id}/{filename}", get_preview, methods=["GET"]),
         ]
 
         if os.path.isfile(os.path.join(frontend_dir, 'index.html')):
@@ -116,7 +234,8 @@ async def main():
             print('Not serving static files (static files not found)')
 
         middleware = [
-            Middleware(CORSMiddleware, allow_origins=args.cors.split(','), allow_methods=["POST"])
+            Middleware(CORSMiddleware, allow_origins=args.cors.split(','), allow_methods=["POST"]),
+            Middleware(uploads.MaxBodySizeMiddleware, max_body_bytes=uploads.max_request_bytes(max_upload_bytes)),
         ]
 
         app = Starlette(debug=True, routes=routes, middleware=middleware)
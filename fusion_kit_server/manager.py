@@ -1,46 +1,87 @@
 import asyncio
 from random import randint
-from broadcaster import Broadcast
 from copy import copy
-import json
-import blurhash_numba
-import numpy
 import os
-from PIL import Image
-from processor import Processor
+import shutil
+from image_store import ImageStore, ImageNotFoundError
+from persister import DreamPersister
+import preview_cache
+from preview_cache import PreviewCache
+from blob_store import BLOB_MEDIA_TYPES, BlobStore, is_blob_hash
+from processor import DEFAULT_MAX_REQUEST_ATTEMPTS, Processor, RetryPolicy
+from processor.masks import MAX_MASK_RADIUS
 import re
-from sqlalchemy import select
+from router import Router
+import thumbnails
+import dream_history
 from ulid import ULID
-import db
+from db_writer import DbWriter
+from repository import Repository
+import uploads
 from domain.dream import Dream
 from domain.settings import Settings
 
-DB_SETTINGS_KEY = 'settings_v0'
+DREAM_IMAGE_ID_REGEX = r'\Adi_[0-9A-Z]{26}\Z'
+
+BLOB_IMAGE_PATH_REGEX = r'\A/images/blob/([0-9a-f]{64})\.([a-z]+)\Z'
 
 class FusionKitManager():
-    def __init__(self, db_config, data_dir):
-        self.db_engine = db_config.db_engine
+    def __init__(
+        self,
+        db_config,
+        data_dir,
+        image_cache_bytes,
+        devices=None,
+        warm_standby=False,
+        max_request_attempts=DEFAULT_MAX_REQUEST_ATTEMPTS,
+        thumbnail_sizes=thumbnails.DEFAULT_THUMBNAIL_SIZES,
+        max_upload_bytes=uploads.DEFAULT_MAX_BYTES,
+        max_upload_pixels=uploads.DEFAULT_MAX_PIXELS,
+    ):
         self.data_dir = data_dir
+        self.devices = devices
+        self.warm_standby = warm_standby
+        self.max_request_attempts = max_request_attempts
+        self.thumbnail_sizes = thumbnail_sizes
+        self.settings = Settings.get_default_settings(pool_devices=devices)
+
+        self.router = Router()
+        self.active_dreams = {}
+
+        self.image_store = ImageStore(
+            max_bytes=image_cache_bytes,
+            persisted_path=self.persisted_image_path,
+        )
+        self.preview_cache = PreviewCache()
+        self.db_writer = DbWriter()
+        self.repository = Repository(db_config=db_config, db_writer=self.db_writer)
+        self.blob_store = BlobStore(images_dir=self.images_dir)
+        self.persister = DreamPersister(
+            images_dir=self.images_dir,
+            db_writer=self.db_writer,
+            blob_store=self.blob_store,
+            thumbnail_sizes=thumbnail_sizes,
+        )
+        self.upload_processor = uploads.UploadProcessor(
+            max_bytes=max_upload_bytes,
+            max_pixels=max_upload_pixels,
+        )
 
+    async def __aenter__(self):
         # Run datababase migrations
-        with self.db_engine.connect() as db_conn:
-            db.run_db_migrations(db_config=db_config, db_conn=db_conn)
-
-        self.settings = Settings.get_default_settings()
-        with db.Session() as session:
-            result = session.execute(
-                select(db.Settings)
-                    .where(db.Settings.key == DB_SETTINGS_KEY)
-                    .limit(1)
-            )
-            settings_row = result.scalar()
-            if settings_row is None:
-                print('Settings not found (first-time setup)')
-            else:
-                settings_json = json.loads(settings_row.settings_json)
-                self.settings = Settings.from_json(settings_json)
+        await self.repository.run_migrations()
+
+        num_deleted_blobs = await self.repository.collect_garbage(self.blob_store)
+        if num_deleted_blobs > 0:
+            print(f"deleted {num_deleted_blobs} unused image file(s)")
 
-        settings_errors = self.settings.validate(self.data_dir)
+        settings_json = await self.repository.load_settings_json()
+        if settings_json is None:
+            print('Settings not found (first-time setup)')
+        else:
+            self.settings = Settings.from_json(settings_json)
+
+        settings_errors = self.settings.validate(self.data_dir, pool_devices=self.devices)
 
         if len(settings_errors) == 0:
             print("loaded settings successfully")
@@ -50,56 +91,76 @@ class FusionKitManager():
             for error in settings_errors:
                 print(error)
 
-
-        self.broadcast = Broadcast("memory://")
-        self.active_dreams = {}
-        self.registered_images = {}
-
-    async def __aenter__(self):
         self.processor = Processor(
-            broadcast=self.broadcast,
+            router=self.router,
             settings=self.settings.to_json(),
             data_dir=self.data_dir,
+            devices=self.devices,
+            warm_standby=self.warm_standby,
+            retry_policy=RetryPolicy(max_attempts=self.max_request_attempts),
         )
+        self.router.add_topic_listener(self.on_topic_changed)
 
-        self.db_conn = self.db_engine.connect()
-        await self.broadcast.connect()
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
-        await self.broadcast.disconnect()
-        self.db_conn.close()
+        await self.persister.close()
+        self.db_writer.close()
+        self.repository.close()
+        self.upload_processor.close()
         self.processor.terminate()
 
     async def start_dream(self, input_options):
         dream_id = f'd_{ULID()}'
 
         options = copy(input_options)
+        priority = options.pop('priority', None) or 0
         if options.get('seed') is None:
             options['seed'] = randint(0, 1000000)
 
         if options.get('base_image') is not None:
             base_image_upload = options['base_image']
-            base_image = Image.open(base_image_upload.file)
+            base_image_mask_upload = options.get('base_image_mask')
+
+            for option in ('base_image_mask_feather', 'base_image_mask_dilate'):
+                radius = options.get(option)
+                if radius is not None and not 0 <= radius <= MAX_MASK_RADIUS:
+                    raise Exception(f"{option} must be between 0 and {MAX_MASK_RADIUS}")
+
+            # Only model-sized images get sent to the runner
+            try:
+                base_images = await self.upload_processor.prepare_base_images(
+                    base_image_upload=base_image_upload,
+                    base_image_mask_upload=base_image_mask_upload,
+                    model_size=self.model_size,
+                )
+            except uploads.UploadError as error:
+                raise Exception(f"invalid base image: {error}") from error
+
+            base_image = base_images['base_image']
             options['base_image'] = base_image
             options['base_image_details'] = {
                 'filename': base_image_upload.filename,
                 'content_type': base_image_upload.content_type,
             }
 
-            base_image_mask_upload = options.get('base_image_mask')
             if base_image_mask_upload is not None:
-                options['base_image_mask'] = Image.open(base_image_mask_upload.file)
+                options['base_image_mask'] = base_images['base_image_mask']
                 options['base_image_mask_details'] = {
-                    'filename': base_image_upload.filename,
-                    'content_type': base_image_upload.content_type,
+                    'filename': base_image_mask_upload.filename,
+                    'content_type': base_image_mask_upload.content_type,
                 }
+            else:
+                options.pop('base_image_mask_feather', None)
+                options.pop('base_image_mask_dilate', None)
 
             options['width'] = base_image.width
-            options['height'] = base_image.width
+            options['height'] = base_image.height
         else:
             options.pop('base_image_decimation', None)
             options.pop('base_image_mask', None)
+            options.pop('base_image_mask_feather', None)
+            options.pop('base_image_mask_dilate', None)
 
         dream_settings = {
             'options': options,
@@ -111,7 +172,9 @@ class FusionKitManager():
         responses = self.processor.send_request_and_watch(
             request_id=dream_id,
             request='dream',
-            body=dream_settings
+            body=dream_settings,
+            priority=priority,
+            cost=dream.num_images * dream.sampler_steps,
         )
 
         watcher_task = asyncio.create_task(dream_watcher(manager=self, dream=dream, responses=responses))
@@ -122,154 +185,279 @@ class FusionKitManager():
 
         return dream
 
-    async def watch_dream(self, dream_id):
+    async def cancel_dream(self, dream_id):
+        active_dream = self.active_dreams.get(dream_id)
+        if active_dream is None:
+            raise Exception(f"active dream not found with ID {dream_id}")
+
+        dream = active_dream['dream']
+        if not dream.is_complete():
+            await self.processor.cancel(dream_id)
+
+        return dream
+
+    async def delete_dream(self, dream_id):
+        """
+        Delete a persisted dream and its images. Returns `False` if there
+        isn't a persisted dream with the ID. Image files shared with other
+        dreams are kept, and unused ones get deleted the next time the
+        server starts.
+        """
+        active_dream = self.active_dreams.get(dream_id)
+        if active_dream is not None and not active_dream['dream'].is_complete():
+            raise Exception(f"dream {dream_id} is still running")
+
+        dream_image_ids = await self.repository.delete_dream(blob_store=self.blob_store, dream_id=dream_id)
+        if dream_image_ids is None:
+            return False
+
+        self.active_dreams.pop(dream_id, None)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, delete_dream_image_dirs, self.images_dir, dream_image_ids)
+        return True
+
+    async def get_dream(self, dream_id):
+        active_dream = self.active_dreams.get(dream_id)
+        if active_dream is not None:
+            return active_dream['dream']
+
+        return await self.repository.get_dream(dream_id)
+
+    async def list_dreams(self, first=None, after=None, prompt=None):
+        return await self.repository.list_dreams(first=first, after=after, prompt=prompt)
+
+    async def search_dreams(self, query, first=None, after=None):
+        return await self.repository.search_dreams(query=query, first=first, after=after)
+
+    async def watch_dream(self, dream_id, max_updates_per_second=None):
+        """
+        Yield the state of a dream each time it changes, until it completes.
+
+        A watcher that can't keep up only gets the latest state, so at most
+        one state is ever waiting to be sent. `max_updates_per_second`
+        additionally limits how often intermediate states are sent; the
+        final state is always sent right away.
+        """
+        if max_updates_per_second is not None and max_updates_per_second <= 0:
+            raise Exception("maxUpdatesPerSecond must be greater than 0")
+
         active_dream = self.active_dreams.get(dream_id)
         if active_dream is None:
             raise Exception(f"active dream not found with ID {dream_id}")
 
         dream = active_dream['dream']
-        yield dream
         if dream.is_complete():
+            yield dream
             return
 
-        async with self.broadcast.subscribe(channel='dream') as subscriber:
-            async for event in subscriber:
-                event_dream = event.message
-                if event_dream.id == dream_id:
-                    yield event_dream
-                    if event_dream.is_complete():
-                        return
+        min_interval = 1 / max_updates_per_second if max_updates_per_second is not None else None
+
+        # Subscribe before yielding the current state so no updates get
+        # missed in between
+        with self.router.subscribe(topic=('dream', dream_id), max_buffered=1, min_interval=min_interval) as subscription:
+            yield copy(dream)
+            async for event_dream in subscription:
+                yield event_dream
+
+    def on_topic_changed(self, topic, has_subscribers):
+        # Runners skip previews for dreams that nobody is watching
+        topic_type, topic_id = topic
+        if topic_type == 'dream':
+            self.processor.set_watched(topic_id, has_subscribers)
 
     def persist_dream(self, dream):
-        with db.Session() as session:
-            dream_dir = os.path.join(self.images_dir, dream.id)
-            base_image_path = None
-            base_image_mask_path = None
-
-            if dream.base_image is not None:
-                os.makedirs(dream_dir, exist_ok=True)
-                base_image_path = os.path.join(dream_dir, 'base-image.png')
-                image_format = dream.base_image.format
-                if image_format is None:
-                    image_format = "PNG"
-                dream.base_image.save(base_image_path, format=image_format)
-
-            if dream.base_image_mask is not None:
-                os.makedirs(dream_dir, exist_ok=True)
-                base_image_mask_path = os.path.join(dream_dir, 'base-image-mask.png')
-                image_format = dream.base_image_mask.format
-                if image_format is None:
-                    image_format = "PNG"
-                dream.base_image_mask.save(base_image_mask_path, format=image_format)
-
-            db_dream = db.Dream(
-                id=dream.id,
-                prompt=dream.prompt,
-                seed=dream.seed,
-                num_images=dream.num_images,
-                settings_json=dream.settings_json(),
-                base_image_path=base_image_path,
-                base_image_mask_path=base_image_mask_path,
-            )
-            session.add(db_dream)
-
-            for index, dream_image in enumerate(dream.images):
-                image_dir = os.path.join(self.images_dir, dream_image.id)
-                os.mkdir(image_dir)
-
-                image_path = os.path.join(image_dir, 'image.png')
-                image = self.get_image(dream_image.image_key)
-                image.save(image_path, format='png')
-
-                image_array = numpy.array(image.convert('RGB'), dtype=numpy.float)
-                image_blurhash = blurhash_numba.encode(image_array)
-
-                db_image = db.DreamImage(
-                    id=dream_image.id,
-                    dream_id=dream_image.dream_id,
-                    seed=dream_image.seed,
-                    index=index,
-                    image_path=os.path.relpath(image_path, start=self.images_dir),
-                    width=image.width,
-                    height=image.height,
-                    blurhash=image_blurhash
-                )
-                session.add(db_image)
+        images = [self.get_image(dream_image.image_key) for dream_image in dream.images]
+        return self.persister.persist(
+            dream=dream,
+            images=images,
+            on_image_persisted=self.mark_image_persisted,
+            on_persist_failed=self.image_store.unpin,
+        )
 
-            session.commit()
+    def mark_image_persisted(self, dream_image, blob):
+        key = dream_image.image_key
+
+        # From now on the image gets served from its blob, so it can still
+        # be found once it's evicted from memory
+        dream_image.image_key = ('blob', blob['hash'], blob['extension'])
+        self.image_store.mark_persisted(key)
+
+    def find_persisted_image_key(self, key):
+        """
+        Return the blob key of a dream image that was persisted after `key`
+        was handed out, or `None` if it hasn't been persisted. This reads the
+        database, so it's only for the image route (which runs in a thread
+        pool), not for the event loop.
+        """
+        if len(key) != 2:
+            return None
+
+        dream_image_id, image_key = key
+        if image_key != 'image' or re.match(DREAM_IMAGE_ID_REGEX, dream_image_id) is None:
+            return None
 
-    def update_settings(self, new_settings):
+        return dream_history.get_dream_image_key(dream_image_id)
+
+    async def update_settings(self, new_settings):
         updated_settings = Settings(
             models=new_settings['models'],
             device=new_settings['device'],
             show_previews=new_settings['show_previews'],
             steps_per_preview=new_settings['steps_per_preview'],
             use_full_precision=new_settings['use_full_precision'],
+            max_batch_size=setting_or_current(new_settings, 'max_batch_size', self.settings.max_batch_size),
+            preview_mode=setting_or_current(new_settings, 'preview_mode', self.settings.preview_mode),
+            preview_max_edge=setting_or_current(new_settings, 'preview_max_edge', self.settings.preview_max_edge),
         )
 
-        errors = updated_settings.validate(self.data_dir)
+        errors = updated_settings.validate(self.data_dir, pool_devices=self.devices)
         if len(errors) > 0:
             raise Exception(f"errors in settings: {', '.join(errors)}")
 
-        with db.Session() as session:
-            db_settings_query = session.execute(
-                select(db.Settings)
-                    .where(db.Settings.key == DB_SETTINGS_KEY)
-                    .limit(1)
-            )
-            db_settings = db_settings_query.scalar()
-
-            if db_settings is not None:
-                db_settings.settings_json = json.dumps(updated_settings.to_json())
-                session.merge(db_settings)
-            else:
-                db_settings = db.Settings(
-                    key=DB_SETTINGS_KEY,
-                    settings_json=json.dumps(updated_settings.to_json())
-                )
-                session.add(db_settings)
-
-            session.commit()
+        await self.repository.save_settings_json(updated_settings.to_json())
 
         self.settings = updated_settings
         self.settings.synthesize_invoke_ai_config(self.invoke_ai_config_path)
         self.processor.update_settings(self.settings.to_json())
 
     def register_image(self, image, key):
-        if key not in self.registered_images:
-            self.registered_images[key] = image
+        self.image_store.register(key=key, image=image)
 
     def get_image(self, key):
-        if key not in self.registered_images:
-            raise Exception(f"Image not found: {key}")
-
-        return self.registered_images[key]
+        return self.image_store.get(key)
 
     def get_image_dimensions(self, key):
-        image = self.get_image(key)
+        width, height = self.image_store.get_dimensions(key)
         return {
-            'width': image.width,
-            'height': image.height,
+            'width': width,
+            'height': height,
         }
 
-    def get_image_by_path(self, path):
+    def get_encoded_image(self, key):
+        return self.image_store.get_encoded(key)
+
+    def get_persisted_image_file(self, key):
+        path = self.persisted_image_path(key)
+        if path is None or not os.path.isfile(path):
+            return None
+
+        return path
+
+    def get_image_key_by_path(self, path):
+        result = re.match(BLOB_IMAGE_PATH_REGEX, path)
+        if result is not None:
+            blob_hash, extension = result.groups()
+            return ('blob', blob_hash, extension)
+
         result = re.search(r'^/images/(.*)\.png$', path)
         if result is None:
-            raise Exception(f"Image not found at path: '{path}'")
+            raise ImageNotFoundError(path)
+
+        return tuple(result.group(1).split('/'))
+
+    def get_image_media_type(self, key):
+        if len(key) == 3 and key[0] == 'blob':
+            return BLOB_MEDIA_TYPES[key[2]]
 
-        image_key = tuple(result.group(1).split('/'))
-        return self.get_image(key=image_key)
+        return 'image/png'
 
     def get_image_uri(self, key):
         if key is None:
             return None
 
-        if key not in self.registered_images:
-            raise Exception(f"Image not found: {key}")
+        if not self.image_store.contains(key):
+            raise ImageNotFoundError(key)
+
+        if key[0] == 'blob':
+            _, blob_hash, extension = key
+            return f"/images/blob/{blob_hash}.{extension}"
 
         segments = '/'.join(key)
         return f"/images/{segments}.png"
 
+    def get_preview_uri(self, preview):
+        if preview is None:
+            return None
+
+        dream_image_id, preview_id = preview['key']
+        filename = preview_cache.preview_filename(preview_id, preview['format'])
+        return f"/previews/{dream_image_id}/{filename}"
+
+    def get_preview(self, dream_image_id, filename):
+        """
+        Return the cached preview for a preview URI's path segments, or
+        `None` if it doesn't exist or has expired.
+        """
+        parsed_filename = preview_cache.parse_preview_filename(filename)
+        if parsed_filename is None:
+            return None
+
+        preview_id, preview_format = parsed_filename
+        preview = self.preview_cache.get((dream_image_id, preview_id))
+        if preview is None or preview['format'] != preview_format:
+            return None
+
+        return preview
+
+    def get_thumbnail_uri(self, dream_image_id, db_thumbnails, size):
+        """
+        Return the URI of the thumbnail closest to `size` out of an image's
+        stored thumbnails, or `None` if the image has no thumbnails (yet).
+        """
+        thumbnails_by_size = {db_thumbnail.size: db_thumbnail for db_thumbnail in db_thumbnails}
+        thumbnail_size = thumbnails.pick_thumbnail_size(thumbnails_by_size.keys(), size)
+        if thumbnail_size is None:
+            return None
+
+        filename = os.path.basename(thumbnails_by_size[thumbnail_size].image_path)
+        return f"/thumbnails/{dream_image_id}/{filename}"
+
+    def get_thumbnail_file(self, dream_image_id, filename):
+        if re.match(DREAM_IMAGE_ID_REGEX, dream_image_id) is None:
+            return None
+
+        if thumbnails.parse_thumbnail_filename(filename) is None:
+            return None
+
+        path = os.path.join(self.images_dir, dream_image_id, filename)
+        if not os.path.isfile(path):
+            return None
+
+        return path
+
+    def persisted_image_path(self, key):
+        """
+        Return the file path for a persisted image key. Final images are
+        stored as blobs, and use `('blob', hash, extension)` keys once
+        they're persisted so they can be found without looking up the
+        database. Images persisted before the blob store existed stay at
+        their original path.
+        """
+        if len(key) == 3 and key[0] == 'blob':
+            _, blob_hash, extension = key
+            if not is_blob_hash(blob_hash) or extension not in BLOB_MEDIA_TYPES:
+                return None
+
+            return self.blob_store.path(blob_hash, extension)
+
+        if len(key) != 2:
+            return None
+
+        owner, image_key = key
+        if image_key != 'image' or re.match(DREAM_IMAGE_ID_REGEX, owner) is None:
+            return None
+
+        return os.path.join(self.images_dir, owner, 'image.png')
+
+    @property
+    def model_size(self):
+        active_model = self.settings.active_model()
+        if active_model is None:
+            return uploads.DEFAULT_MODEL_SIZE
+
+        return (active_model['width'], active_model['height'])
+
     @property
     def images_dir(self):
         return os.path.join(self.data_dir, 'images')
@@ -283,47 +471,97 @@ class FusionKitManager():
         return self.data_dir.join('/invoke-ai-config.yml')
 
 async def dream_watcher(manager, dream, responses):
-    broadcast = manager.broadcast
-
-    async for response in responses:
-        if response.get('error') is not None:
-            dream.state = 'StoppedDream'
-            dream.reason = "DREAM_ERROR"
-            dream.message = f"Error running dream: {response['error']}"
-            for image in dream.images:
-                image.state = 'StoppedDreamImage'
-        elif response.get('state') == 'running':
-            dream.state = 'RunningDream'
-            for i, image in enumerate(response['image_progress']):
-                if image['state'] == 'pending':
-                    dream.images[i].state = 'PendingDreamImage'
-                elif image['state'] == 'running':
-                    dream.images[i].state = 'RunningDreamImage'
-                elif image['state'] == 'complete':
-                    dream.images[i].state = 'FinishedDreamImage'
-                else:
-                    print(f"warning: unexpected image state: {image['state']}")
+    try:
+        async for response in responses:
+            if response.get('state') == 'queued':
+                # The dream is still pending, but its queue position has changed
+                pass
+            elif response.get('state') == 'cancelled':
+                dream.state = 'StoppedDream'
+                dream.reason = "DREAM_CANCELLED"
+                dream.message = "Dream was cancelled"
+                for image in dream.images:
+                    if not image.is_complete():
+                        image.state = 'StoppedDreamImage'
+            elif response.get('error') is not None:
+                dream.state = 'StoppedDream'
+                dream.reason = "DREAM_ERROR"
+                dream.message = f"Error running dream: {response['error']}"
+                for image in dream.images:
+                    image.state = 'StoppedDreamImage'
+            elif response.get('state') == 'running':
+                dream.state = 'RunningDream'
+                apply_image_update(manager=manager, dream=dream, image_update=response['image_update'])
+            elif response.get('state') == 'complete':
+                dream.state = 'FinishedDream'
+                for i, image in enumerate(response['images']):
+                    if image['state'] != 'complete':
+                        raise Exception(f"Unexpected final image state: {image['state']}")
 
-                if image.get('image') is not None:
                     image_key = (dream.images[i].id, image['image_key'])
                     manager.register_image(image=image['image'], key=image_key)
+
+                    dream.images[i].state = 'FinishedDreamImage'
                     dream.images[i].image_key = image_key
+                    dream.images[i].num_finished_steps = image.get('completed_steps', 0)
+
+                # Saving runs in the background, so the finished dream gets
+                # published without waiting for it
+                manager.persist_dream(dream)
+            else:
+                raise Exception(f"Unknown dream state: {response.get('state')}")
+
+            dream_topic = ('dream', dream.id)
+            if manager.router.has_subscribers(dream_topic):
+                manager.router.publish(
+                    topic=dream_topic,
+                    message=copy(dream),
+                    final=dream.is_complete(),
+                )
+    finally:
+        # Previews stop being useful once the dream stops, even if watching
+        # it failed partway through
+        for image in dream.images:
+            manager.preview_cache.release(image.id)
+
+def apply_image_update(manager, dream, image_update):
+    dream_image = dream.images[image_update['index']]
+
+    if image_update['state'] == 'pending':
+        dream_image.state = 'PendingDreamImage'
+    elif image_update['state'] == 'running':
+        dream_image.state = 'RunningDreamImage'
+    elif image_update['state'] == 'complete':
+        dream_image.state = 'FinishedDreamImage'
+    else:
+        print(f"warning: unexpected image state: {image_update['state']}")
+
+    if image_update.get('preview') is not None:
+        preview = image_update['preview']
+        preview_key = (dream_image.id, image_update['image_key'])
+        manager.preview_cache.put(preview_key, preview)
+        dream_image.preview = {
+            'key': preview_key,
+            'format': preview['format'],
+            'width': preview['width'],
+            'height': preview['height'],
+        }
 
-                dream.images[i].num_finished_steps = image.get('completed_steps', 0)
-        elif response.get('state') == 'complete':
-            dream.state = 'FinishedDream'
-            for i, image in enumerate(response['images']):
-                if image['state'] != 'complete':
-                    raise Exception(f"Unexpected final image state: {image['state']}")
+    dream_image.num_finished_steps = image_update.get('completed_steps', 0)
 
-                image_key = (dream.images[i].id, image['image_key'])
-                manager.register_image(image=image['image'], key=image_key)
+def delete_dream_image_dirs(images_dir, dream_image_ids):
+    # Each image's directory holds its thumbnails (and the image itself, for
+    # images saved before the blob store existed)
+    for dream_image_id in dream_image_ids:
+        shutil.rmtree(os.path.join(images_dir, dream_image_id), ignore_errors=True)
 
-                dream.images[i].state = 'FinishedDreamImage'
-                dream.images[i].image_key = image_key
-                dream.images[i].num_finished_steps = image.get('completed_steps', 0)
-            manager.persist_dream(dream)
-        else:
-            raise Exception(f"Unknown dream state: {response.get('state')}")
+def setting_or_current(new_settings, name, current):
+    """
+    Return a setting from `new_settings`, or `current` if it's missing or
+    null (clients that don't know about a setting leave it out or send null).
+    """
+    value = new_settings.get(name)
+    if value is None:
+        return current
 
-        await broadcast.publish(channel='dream', message=copy(dream))
+    return value
@@ -0,0 +1,170 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
+import traceback
+import db
+import image_blurhash
+import thumbnails
+
+DEFAULT_MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+class DreamPersister():
+    """
+    Saves finished dreams to the blob store and to the database in the
+    background.
+
+    Each dream is persisted by a pipeline of jobs running on a thread pool:
+    base images are saved first, then every output image is encoded,
+    blurhashed and thumbnailed (at each of `thumbnail_sizes`) in parallel,
+    and finally all database rows are handed to
+    `db_writer` to be committed together. The event loop only schedules the
+    jobs, so dreams can be published to subscribers without waiting for
+    them to be saved.
+    """
+
+    def __init__(self, images_dir, db_writer, blob_store, thumbnail_sizes=thumbnails.DEFAULT_THUMBNAIL_SIZES, max_workers=DEFAULT_MAX_WORKERS):
+        self.images_dir = images_dir
+        self.db_writer = db_writer
+        self.blob_store = blob_store
+        self.thumbnail_sizes = thumbnail_sizes
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='persister')
+        self.tasks = set()
+
+        image_blurhash.warm_up()
+
+    def persist(self, dream, images, on_image_persisted, on_persist_failed):
+        """
+        Start persisting a dream in the background. `images` should contain
+        the final image for each of the dream's images, in order.
+        `on_image_persisted` is called on the event loop with each dream
+        image and its blob once the dream's rows have been committed. If
+        saving fails, `on_persist_failed` is called with each image's key
+        instead.
+        """
+        task = asyncio.create_task(self._persist(
+            dream=dream,
+            images=images,
+            on_image_persisted=on_image_persisted,
+            on_persist_failed=on_persist_failed,
+        ))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def close(self):
+        if len(self.tasks) > 0:
+            print(f"waiting for {len(self.tasks)} dream(s) to finish saving")
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        self.executor.shutdown(wait=True)
+
+    async def _persist(self, dream, images, on_image_persisted, on_persist_failed):
+        loop = asyncio.get_running_loop()
+
+        try:
+            base_image_blobs = await loop.run_in_executor(
+                self.executor,
+                save_base_images,
+                self.blob_store,
+                dream.base_image,
+                dream.base_image_mask,
+            )
+
+            saved_images = await asyncio.gather(*[
+                loop.run_in_executor(
+                    self.executor,
+                    save_dream_image,
+                    self.images_dir,
+                    self.blob_store,
+                    dream_image.id,
+                    image,
+                    self.thumbnail_sizes,
+                )
+                for dream_image, image in zip(dream.images, images)
+            ])
+
+            await self.db_writer.write(partial(
+                add_dream_rows,
+                blob_store=self.blob_store,
+                dream=dream,
+                base_image_blobs=base_image_blobs,
+                saved_images=saved_images,
+            ))
+        except Exception:
+            print(f"error saving dream {dream.id}:")
+            traceback.print_exc()
+
+            # Any blob files that did get written are orphans now, and get
+            # cleaned up by the blob store's garbage collection
+            for dream_image in dream.images:
+                on_persist_failed(dream_image.image_key)
+            return
+
+        # Images only get served from their blobs once their rows exist
+        for dream_image, saved_image in zip(dream.images, saved_images):
+            on_image_persisted(dream_image, saved_image['blob'])
+
+def save_base_images(blob_store, base_image, base_image_mask):
+    base_image_blob = None
+    base_image_mask_blob = None
+
+    if base_image is not None:
+        base_image_blob = blob_store.put_image(base_image, image_format=base_image.format or 'PNG')
+
+    if base_image_mask is not None:
+        base_image_mask_blob = blob_store.put_image(base_image_mask, image_format=base_image_mask.format or 'PNG')
+
+    return {
+        'base_image': base_image_blob,
+        'base_image_mask': base_image_mask_blob,
+    }
+
+def save_dream_image(images_dir, blob_store, dream_image_id, image, thumbnail_sizes):
+    blob = blob_store.put_image(image, image_format='png')
+
+    return {
+        'blob': blob,
+        'width': image.width,
+        'height': image.height,
+        'blurhash': image_blurhash.encode(image),
+        'thumbnails': thumbnails.save_thumbnails(images_dir, dream_image_id, image, thumbnail_sizes),
+    }
+
+def add_dream_rows(session, blob_store, dream, base_image_blobs, saved_images):
+    base_image_blob = base_image_blobs['base_image']
+    base_image_mask_blob = base_image_blobs['base_image_mask']
+
+    for blob in (base_image_blob, base_image_mask_blob):
+        if blob is not None:
+            blob_store.add_ref(session, blob)
+
+    db_dream = db.Dream(
+        id=dream.id,
+        prompt=dream.prompt,
+        seed=dream.seed,
+        num_images=dream.num_images,
+        settings_json=dream.settings_json(),
+        base_image_path=base_image_blob['image_path'] if base_image_blob is not None else None,
+        base_image_mask_path=base_image_mask_blob['image_path'] if base_image_mask_blob is not None else None,
+        base_image_blob_hash=base_image_blob['hash'] if base_image_blob is not None else None,
+        base_image_mask_blob_hash=base_image_mask_blob['hash'] if base_image_mask_blob is not None else None,
+    )
+    session.add(db_dream)
+
+    for index, (dream_image, saved_image) in enumerate(zip(dream.images, saved_images)):
+        blob_store.add_ref(session, saved_image['blob'])
+
+        db_image = db.DreamImage(
+            id=dream_image.id,
+            dream_id=dream_image.dream_id,
+            seed=dream_image.seed,
+            index=index,
+            image_path=saved_image['blob']['image_path'],
+            width=saved_image['width'],
+            height=saved_image['height'],
+            blurhash=saved_image['blurhash'],
+            blob_hash=saved_image['blob']['hash'],
+        )
+        session.add(db_image)
+        thumbnails.add_thumbnail_rows(session, dream_image.id, saved_image['thumbnails'])
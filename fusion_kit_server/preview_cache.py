@@ -0,0 +1,113 @@
+from collections import OrderedDict
+import re
+import time
+from image_store import content_etag
+
+DEFAULT_TTL_SECONDS = 60
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+PREVIEW_EXTENSIONS = {
+    'webp': 'webp',
+    'jpeg': 'jpg',
+}
+
+PREVIEW_MEDIA_TYPES = {
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+}
+
+PREVIEW_FILENAME_REGEX = r'\A(preview_[0-9A-Z]{26})\.([a-z]+)\Z'
+
+def preview_filename(preview_id, preview_format):
+    return f'{preview_id}.{PREVIEW_EXTENSIONS[preview_format]}'
+
+def parse_preview_filename(filename):
+    """
+    Return the `(preview_id, format)` of a preview filename, or `None` if it
+    isn't a valid preview filename.
+    """
+    result = re.match(PREVIEW_FILENAME_REGEX, filename)
+    if result is None:
+        return None
+
+    preview_id, extension = result.groups()
+    preview_format = next(
+        (preview_format for preview_format, format_extension in PREVIEW_EXTENSIONS.items() if format_extension == extension),
+        None,
+    )
+    if preview_format is None:
+        return None
+
+    return preview_id, preview_format
+
+class PreviewCache():
+    """
+    A short-lived in-memory store of encoded preview images, kept apart from
+    `ImageStore` since previews are never persisted or re-encoded.
+
+    Previews arrive from the runner already encoded and are served as-is.
+    The latest preview of each dream image is kept until a newer one
+    replaces it or the image is released, then expires `ttl_seconds` later
+    (so clients that are a little behind can still load it). Once the cache
+    grows past `max_bytes`, previews that are no longer the latest get
+    dropped early, oldest first.
+
+    Keys are tuples of `(dream_image_id, preview_id)`. The cache is only
+    used from the event loop, so it doesn't need a lock.
+    """
+
+    def __init__(self, ttl_seconds=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_MAX_BYTES):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self.latest_previews = {}
+        self.total_bytes = 0
+
+        # The expiry time of each released preview. Every preview gets the
+        # same TTL, so release order is also expiry order
+        self.released = OrderedDict()
+
+    def put(self, key, preview):
+        if key in self.entries:
+            return
+
+        owner = key[0]
+        self.release(owner)
+
+        self.entries[key] = {
+            **preview,
+            'etag': content_etag(preview['data']),
+        }
+        self.latest_previews[owner] = key
+        self.total_bytes += len(preview['data'])
+        self._evict()
+
+    def release(self, dream_image_id):
+        """
+        Start the expiry countdown for a dream image's latest preview, such
+        as when a newer preview or the final image is available.
+        """
+        key = self.latest_previews.pop(dream_image_id, None)
+        if key in self.entries:
+            self.released[key] = time.monotonic() + self.ttl_seconds
+
+    def get(self, key):
+        """
+        Return the preview for `key`, with its `data`, `etag`, `format`,
+        `width` and `height`, or `None` if it has expired.
+        """
+        self._evict()
+        return self.entries.get(key)
+
+    def _evict(self):
+        # Only the oldest released previews ever need to be checked
+        now = time.monotonic()
+        while len(self.released) > 0:
+            key, expires_at = next(iter(self.released.items()))
+            if expires_at > now and self.total_bytes <= self.max_bytes:
+                break
+
+            self.released.popitem(last=False)
+            entry = self.entries.pop(key)
+            self.total_bytes -= len(entry['data'])
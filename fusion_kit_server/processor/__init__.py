@@ -1,9 +1,6 @@
-import asyncio
-import queue
+import os
 from time import time
-from broadcaster import Broadcast
-import multiprocessing
-from .runner import processor_runner
+from .pool import RunnerSlot
 
 class ProcessorError(Exception):
     pass
@@ -13,117 +10,315 @@ class WatchdogFailedError(ProcessorError):
         super().__init__(f"runner process died while waiting for response")
         self.request_id = request_id
 
+DEFAULT_MAX_REQUEST_ATTEMPTS = 2
+
+# How quickly the estimated request duration adapts to new measurements
+DURATION_SMOOTHING = 0.3
+
+# Requests that are safe to run again from the start if a runner dies
+RETRYABLE_REQUESTS = {'dream'}
+
+class RetryPolicy():
+    def __init__(self, max_attempts=DEFAULT_MAX_REQUEST_ATTEMPTS):
+        self.max_attempts = max_attempts
+
+    def should_retry(self, request, attempts):
+        return request in RETRYABLE_REQUESTS and attempts < self.max_attempts
+
 class Processor():
-    def __init__(self, broadcast, settings, data_dir):
+    """
+    Runs requests on a pool of runner processes, with one runner per device
+    in `devices`. When `devices` isn't set, a single runner uses the device
+    from the settings. The same device can be listed more than once, e.g.
+    to run several CPU runners.
+    """
+
+    def __init__(self, router, settings, data_dir, devices=None, warm_standby=False, retry_policy=None):
         self.settings = settings
         self.data_dir = data_dir
-        self.runner_process = None
-        self.broadcast = broadcast
-        self.active_requests = set()
-        self.run(recreate_queues=True)
+        self.router = router
+        self.warm_standby = warm_standby
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.queued_requests = {}
+        self.active_requests = {}
+        self.watched_requests = set()
+        self.request_sequence = 0
+        self.seconds_per_cost = None
 
-        self.broadcast_task = asyncio.create_task(runner_broadcaster(self))
-        self.watchdog_task = asyncio.create_task(runner_watchdog(self))
+        if devices is None or len(devices) == 0:
+            devices = [None]
 
-    def is_running(self):
-        return self.runner_process is not None and self.runner_process.is_alive()
-
-    def run(self, recreate_queues=True):
-        if not self.is_running():
-            if recreate_queues:
-                self.req_queue = multiprocessing.Queue()
-                self.res_queue = multiprocessing.Queue()
-
-                self.req_queue.cancel_join_thread()
-                self.res_queue.cancel_join_thread()
-
-            self.runner_process = multiprocessing.Process(
-                target=processor_runner,
-                kwargs={
-                    'settings': self.settings,
-                    'data_dir': self.data_dir,
-                    'req_queue': self.req_queue,
-                    'res_queue': self.res_queue,
-                }
+        # Split CPU cores between CPU runners so they don't oversubscribe
+        num_cpu_runners = sum(1 for device in devices if device == 'cpu')
+        cpu_threads = max(1, (os.cpu_count() or 1) // num_cpu_runners) if num_cpu_runners > 0 else None
+
+        self.slots = [
+            RunnerSlot(
+                processor=self,
+                index=index,
+                device=device,
+                cpu_threads=cpu_threads if device == 'cpu' else None,
             )
-            self.runner_process.start()
+            for index, device in enumerate(devices)
+        ]
+        for slot in self.slots:
+            slot.run()
+
+    def is_running(self):
+        return any(slot.is_running() for slot in self.slots)
+
+    def pick_slot(self):
+        """
+        Pick an idle slot to run a request, preferring healthy slots. Returns
+        `None` if every slot is busy.
+        """
+        idle_slots = [slot for slot in self.slots if slot.num_active_requests() == 0]
+        healthy_slots = [slot for slot in idle_slots if slot.is_healthy()]
+        if any(slot.is_healthy() for slot in self.slots):
+            idle_slots = healthy_slots
+
+        if len(idle_slots) == 0:
+            return None
 
-    async def send_request_and_watch(self, request_id, request, body):
-        self.active_requests.add(request_id)
-        self.run()
+        return min(idle_slots, key=lambda slot: slot.index)
 
-        async with self.broadcast.subscribe(channel='response') as subscriber:
-            self.req_queue.put({
+    def queued_request_ids(self):
+        """
+        Return the IDs of queued requests in the order they will run: highest
+        priority first, then first-come first-served.
+        """
+        return sorted(
+            self.queued_requests,
+            key=lambda request_id: (
+                -self.queued_requests[request_id]['priority'],
+                self.queued_requests[request_id]['sequence'],
+            ),
+        )
+
+    async def enqueue(self, request_id, queued_request):
+        self.queued_requests[request_id] = queued_request
+        await self.schedule()
+
+    async def schedule(self):
+        """
+        Dispatch queued requests to idle slots, then let the requests that are
+        still waiting know their new queue position.
+        """
+        for request_id in self.queued_request_ids():
+            slot = self.pick_slot()
+            if slot is None:
+                break
+
+            self.dispatch(request_id, self.queued_requests.pop(request_id), slot)
+
+        for queue_position, request_id in enumerate(self.queued_request_ids()):
+            self.publish_response({
                 'request_id': request_id,
+                'stopped': False,
+                'body': {
+                    'state': 'queued',
+                    'queue_position': queue_position,
+                },
+            })
+
+    def dispatch(self, request_id, active_request, slot):
+        active_request['slot'] = slot
+        active_request['started_at'] = time()
+        self.active_requests[request_id] = active_request
+
+        slot.run()
+        slot.runner.set_previews_request(request_id if request_id in self.watched_requests else None)
+        slot.runner.send(
+            request_id=request_id,
+            request=active_request['request'],
+            body=active_request['body'],
+        )
+
+    async def finish_request(self, request_id, slot, completed):
+        """
+        Free up a request's slot once the runner has stopped it. Only
+        requests that `completed` count towards the slot's health, and are
+        used to estimate durations (since cancelled and failed requests stop
+        partway through).
+        """
+        active_request = self.active_requests.pop(request_id, None)
+        if completed:
+            slot.consecutive_failures = 0
+
+        if active_request is not None and completed:
+            seconds_per_cost = (time() - active_request['started_at']) / active_request['cost']
+            if self.seconds_per_cost is None:
+                self.seconds_per_cost = seconds_per_cost
+            else:
+                self.seconds_per_cost += DURATION_SMOOTHING * (seconds_per_cost - self.seconds_per_cost)
+
+        await self.schedule()
+
+    async def send_request_and_watch(self, request_id, request, body, priority=0, cost=1):
+        """
+        Queue a request and yield each of its responses. Higher `priority`
+        requests run first. `cost` is an estimate of how much work the
+        request takes relative to other requests (such as its number of
+        sampler steps), used to estimate start times.
+        """
+        self.request_sequence += 1
+
+        # Every response matters (dropping the final one would leave the
+        # request hanging), so they're never dropped
+        with self.router.subscribe(topic=('response', request_id), max_buffered=None) as subscription:
+            await self.enqueue(request_id, {
                 'request': request,
                 'body': body,
+                'attempts': 1,
+                'priority': priority,
+                'sequence': self.request_sequence,
+                'cost': max(cost, 1),
             })
 
-            async for event in subscriber:
-                response = event.message
-                if response.get('request_id') == request_id:
-                    yield response.get('body')
-                    if response.get('stopped', False):
-                         return
+            async for response in subscription:
+                yield response.get('body')
 
-    def update_settings(self, settings):
-        self.settings = settings
-        self.restart()
+    def publish_response(self, response):
+        """
+        Deliver a response to whoever is watching its request. A stopped
+        response is the last one for its request.
+        """
+        self.router.publish(
+            topic=('response', response.get('request_id')),
+            message=response,
+            final=response.get('stopped', False),
+        )
+
+    async def cancel(self, request_id):
+        """
+        Cancel a queued or running request. Running requests stop after their
+        current sampler step. Returns `False` if the request isn't queued or
+        running.
+        """
+        if request_id in self.queued_requests:
+            del self.queued_requests[request_id]
+            self.publish_response({
+                'request_id': request_id,
+                'stopped': True,
+                'body': {
+                    'state': 'cancelled',
+                },
+            })
+            await self.schedule()
+            return True
+
+        active_request = self.active_requests.get(request_id)
+        if active_request is not None:
+            active_request['slot'].runner.cancel(request_id)
+            return True
+
+        return False
+
+    def set_watched(self, request_id, watched):
+        """
+        Set whether anyone is watching a request's progress. Runners only
+        generate previews for watched requests. Requests that haven't
+        started yet pick this up when they get dispatched.
+        """
+        if watched:
+            self.watched_requests.add(request_id)
+        else:
+            self.watched_requests.discard(request_id)
+
+        active_request = self.active_requests.get(request_id)
+        if active_request is not None:
+            active_request['slot'].runner.set_previews_request(request_id if watched else None)
+
+    def get_queue_position(self, request_id):
+        queued_request_ids = self.queued_request_ids()
+        if request_id not in queued_request_ids:
+            return None
+
+        return queued_request_ids.index(request_id)
+
+    def estimate_start_time(self, request_id):
+        """
+        Estimate when a queued request will start as a Unix timestamp, based
+        on how long previous requests took. Returns `None` if the request
+        isn't queued or no requests have finished yet.
+        """
+        if self.seconds_per_cost is None or request_id not in self.queued_requests:
+            return None
 
-    def restart(self):
-        self.run()
+        now = time()
 
-        self.req_queue.put({
-            'request_id': None,
-            'request': 'stop',
-            'body': {},
-        })
+        # Simulate the queue, starting with when each slot's current request
+        # should finish
+        slot_free_times = []
+        for slot in self.slots:
+            slot_requests = [
+                active_request for active_request in self.active_requests.values()
+                if active_request['slot'] is slot
+            ]
+            free_time = now
+            for active_request in slot_requests:
+                expected_end = active_request['started_at'] + active_request['cost'] * self.seconds_per_cost
+                free_time = max(free_time, expected_end)
+            slot_free_times.append(free_time)
 
-        self.restart_task = asyncio.create_task(finish_restart(self))
+        for queued_request_id in self.queued_request_ids():
+            start_time = min(slot_free_times)
+            if queued_request_id == request_id:
+                return start_time
+
+            queued_request = self.queued_requests[queued_request_id]
+            slot_free_times[slot_free_times.index(start_time)] = start_time + queued_request['cost'] * self.seconds_per_cost
+
+        return None
+
+    async def recover_slot(self, slot):
+        """
+        Replace a slot's runner after it exits unexpectedly. Its requests are
+        queued again if the retry policy allows it, and fail otherwise.
+        """
+        failed_requests = {
+            request_id: active_request
+            for request_id, active_request in self.active_requests.items()
+            if active_request['slot'] is slot
+        }
+        if len(failed_requests) == 0 and not self.warm_standby:
+            # Idle runners get restarted on demand
+            return
+
+        print(f"runner {slot.name} exited unexpectedly")
+        slot.consecutive_failures += 1
+        for request_id in failed_requests:
+            del self.active_requests[request_id]
+
+        # Replaces the dead runner, promoting the standby if there is one
+        slot.run()
+
+        for request_id, active_request in failed_requests.items():
+            if self.retry_policy.should_retry(active_request['request'], active_request['attempts']):
+                active_request['attempts'] += 1
+                print(f"retrying request {request_id} (attempt {active_request['attempts']})")
+
+                # Retried requests keep their original place in the queue
+                self.queued_requests[request_id] = active_request
+            else:
+                self.publish_response({
+                    'request_id': request_id,
+                    'stopped': True,
+                    'body': {
+                        'error': WatchdogFailedError(request_id)
+                    },
+                })
+
+        await self.schedule()
+
+    def update_settings(self, settings):
+        # Runners apply new settings between dreams, and load a new model in
+        # the background if needed
+        self.settings = settings
+        for slot in self.slots:
+            slot.update_settings()
 
     def terminate(self):
-        print("terminating runner")
-        self.runner_process.terminate()
-
-async def runner_broadcaster(processor):
-    loop = asyncio.get_running_loop()
-    while True:
-        try:
-            response = await loop.run_in_executor(None, processor.res_queue.get, True, 5)
-        except queue.Empty:
-            response = None
-
-        if response is not None:
-            await processor.broadcast.publish(channel="response", message=response)
-
-            request_id = response.get("request_id")
-            is_stopped = response.get("stopped", False)
-            if request_id is not None and is_stopped:
-                processor.active_requests.discard(request_id)
-
-async def runner_watchdog(processor):
-    print("started watchdog")
-    while True:
-        if len(processor.active_requests) > 0 and not processor.is_running():
-            print("watchdog failed")
-            for request_id in processor.active_requests:
-                await processor.broadcast.publish(
-                    channel="response",
-                    message={
-                        'request_id': request_id,
-                        'stopped': True,
-                        'body': {
-                            'error': WatchdogFailedError(request_id)
-                        },
-                    }
-                )
-            processor.active_requests.clear()
-
-        await asyncio.sleep(5)
-
-
-async def finish_restart(processor):
-    loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, processor.runner_process.join)
-
-    processor.run(recreate_queues=False)
+        print("terminating runners")
+        for slot in self.slots:
+            slot.terminate()
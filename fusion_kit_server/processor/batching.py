@@ -0,0 +1,129 @@
+from contextlib import nullcontext
+import re
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.plms import PLMSSampler
+import torch
+
+try:
+    from ldm.dream.conditioning import get_uc_and_c
+except ImportError:
+    get_uc_and_c = None
+
+LATENT_CHANNELS = 4
+LATENT_DOWNSAMPLING_FACTOR = 8
+
+def is_out_of_memory_error(error):
+    return isinstance(error, RuntimeError) and 'out of memory' in str(error)
+
+def free_memory():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def is_weighted_prompt(prompt):
+    """
+    Return whether a prompt has weighted subprompts (like `a cat:2 a dog:1`).
+    Any unescaped colon splits a prompt into subprompts.
+    """
+    return re.search(r'(?<!\\):', prompt) is not None
+
+def can_batch_prompt(prompt):
+    """
+    Return whether `sample_batch` conditions `prompt` the same way as the
+    generator would. Weighted subprompts need invoke's conditioning helper.
+    """
+    return get_uc_and_c is not None or not is_weighted_prompt(prompt)
+
+def get_conditioning(model, prompt):
+    """
+    Return the `(unconditional_conditioning, conditioning)` for a prompt,
+    blending weighted subprompts the same way as the generator.
+    """
+    if get_uc_and_c is not None:
+        return get_uc_and_c(prompt, model=model, log_tokens=False, skip_normalize=False)
+
+    return model.get_learned_conditioning(['']), model.get_learned_conditioning([prompt])
+
+def make_sampler(sampler_name, model):
+    if sampler_name == 'ddim':
+        return DDIMSampler(model, device=model.device)
+    elif sampler_name == 'plms':
+        return PLMSSampler(model, device=model.device)
+    else:
+        raise Exception(f'Unknown sampler: {sampler_name}')
+
+def precision_scope(model, full_precision):
+    if full_precision or model.device.type != 'cuda':
+        return nullcontext()
+
+    return torch.autocast(device_type='cuda')
+
+def seeded_noise(seed, shape, device):
+    # Match the noise used when generating a single image with the same seed
+    torch.manual_seed(seed)
+    if device.type == 'mps':
+        return torch.randn([1, *shape], device='cpu').to(device)
+    else:
+        return torch.randn([1, *shape], device=device)
+
+def sample_batch(
+    generator,
+    prompt,
+    seeds,
+    width,
+    height,
+    sampler_name,
+    sampler_steps,
+    sampler_eta,
+    guidance_scale,
+    full_precision,
+    step_callbacks,
+):
+    """
+    Generate one image per seed from a text prompt, denoising all of the
+    images together in a single sampler run. Returns a list of
+    `(image, seed)` tuples in the same order as `seeds`.
+
+    The starting noise for each image is derived from its own seed, so with
+    deterministic sampling (`sampler_eta` of 0) each image matches the one
+    that would be generated on its own. `step_callbacks` contains a step
+    callback (or `None`) per image, which gets called with that image's
+    samples.
+    """
+    model = generator.load_model()
+    sampler = make_sampler(sampler_name, model)
+    batch_size = len(seeds)
+    shape = [
+        LATENT_CHANNELS,
+        height // LATENT_DOWNSAMPLING_FACTOR,
+        width // LATENT_DOWNSAMPLING_FACTOR,
+    ]
+
+    def img_callback(samples, step_index):
+        for index, step_callback in enumerate(step_callbacks):
+            if step_callback is not None:
+                step_callback(samples[index:index + 1], step_index)
+
+    with torch.no_grad(), precision_scope(model, full_precision), model.ema_scope():
+        # The conditioning is the same for every image in the batch, so it
+        # only needs to be computed once
+        unconditional_conditioning, conditioning = get_conditioning(model, prompt)
+
+        x_T = torch.cat([seeded_noise(seed, shape, model.device) for seed in seeds])
+
+        samples, _ = sampler.sample(
+            S=sampler_steps,
+            batch_size=batch_size,
+            shape=shape,
+            conditioning=conditioning.expand(batch_size, -1, -1),
+            unconditional_conditioning=unconditional_conditioning.expand(batch_size, -1, -1),
+            unconditional_guidance_scale=guidance_scale,
+            eta=sampler_eta,
+            x_T=x_T,
+            img_callback=img_callback,
+            verbose=False,
+        )
+
+        return [
+            (generator.sample_to_image(samples[index:index + 1]), seed)
+            for index, seed in enumerate(seeds)
+        ]
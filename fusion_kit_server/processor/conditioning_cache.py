@@ -0,0 +1,68 @@
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+def tensor_bytes(tensor):
+    return tensor.element_size() * tensor.nelement()
+
+class ConditioningCache():
+    """
+    An LRU cache of text encoder outputs, so repeated prompts don't need to
+    run through the text encoder again.
+
+    Entries are keyed by the model, its precision and the encoded texts. The
+    cache holds at most `max_bytes` worth of tensors, and must be cleared
+    whenever a different model gets loaded.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+    def install(self, model, model_key):
+        """
+        Wrap `model.get_learned_conditioning` with the cache.
+        """
+        get_uncached_conditioning = model.get_learned_conditioning
+
+        def get_learned_conditioning(texts):
+            if not isinstance(texts, (list, tuple)) or not all(isinstance(text, str) for text in texts):
+                return get_uncached_conditioning(texts)
+
+            key = (model_key, tuple(texts))
+            conditioning = self.get(key)
+            if conditioning is None:
+                conditioning = get_uncached_conditioning(texts).detach()
+                self.put(key, conditioning)
+
+            return conditioning
+
+        model.get_learned_conditioning = get_learned_conditioning
+
+    def get(self, key):
+        conditioning = self.entries.get(key)
+        if conditioning is not None:
+            self.entries.move_to_end(key)
+
+        return conditioning
+
+    def put(self, key, conditioning):
+        size = tensor_bytes(conditioning)
+        if size > self.max_bytes:
+            return
+
+        previous_conditioning = self.entries.pop(key, None)
+        if previous_conditioning is not None:
+            self.total_bytes -= tensor_bytes(previous_conditioning)
+
+        self.entries[key] = conditioning
+        self.total_bytes += size
+
+        while self.total_bytes > self.max_bytes:
+            _, evicted_conditioning = self.entries.popitem(last=False)
+            self.total_bytes -= tensor_bytes(evicted_conditioning)
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
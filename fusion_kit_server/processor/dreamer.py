@@ -2,7 +2,10 @@ from itertools import islice
 from ldm.generate import Generate
 import numpy
 import os
-from PIL import Image
+from .batching import can_batch_prompt, free_memory, is_out_of_memory_error, sample_batch
+from .conditioning_cache import ConditioningCache
+from .masks import prepare_image_mask
+from .previews import sample_to_preview_image
 from transformers import CLIPTokenizer, CLIPTextModel, logging
 from ulid import ULID
 
@@ -24,21 +27,65 @@ class Dreamer():
         CLIPTextModel.from_pretrained(CLIP_VERSION)
         logging.set_verbosity_warning()
 
+        self.data_dir = data_dir
+        self.generator = None
+        self.conditioning_cache = ConditioningCache()
+        self.load_generator(settings)
+
+    def load_generator(self, settings):
+        self.use_generator(self.create_generator(settings))
+
+    def create_generator(self, settings):
+        """
+        Load the model for the active model in `settings`. This doesn't
+        affect the current generator, so it can run in a separate thread
+        while the current generator is still in use.
+        """
         active_model = next((model for model in settings['models'] if model['is_active']), None)
 
-        if active_model is not None:
-            weights = os.path.join(data_dir, 'models', active_model['weights_filename'])
-            config = os.path.join(data_dir, 'configs', active_model['config_filename'])
-            device = settings['device']
-            full_precision = settings['use_full_precision']
-
-            self.generator = Generate(
-                weights=weights,
-                config=config,
-                device_type=device,
-                full_precision=full_precision,
+        if active_model is None:
+            return {
+                'generator': None,
+                'model': None,
+                'model_key': None,
+                'full_precision': settings['use_full_precision'],
+            }
+
+        weights = os.path.join(self.data_dir, 'models', active_model['weights_filename'])
+        config = os.path.join(self.data_dir, 'configs', active_model['config_filename'])
+        device = settings['device']
+        full_precision = settings['use_full_precision']
+
+        generator = Generate(
+            weights=weights,
+            config=config,
+            device_type=device,
+            full_precision=full_precision,
+        )
+        model = generator.load_model()
+
+        return {
+            'generator': generator,
+            'model': model,
+            'model_key': (weights, config, device, full_precision),
+            'full_precision': full_precision,
+        }
+
+    def use_generator(self, loaded_generator):
+        # Cached conditioning is only valid for the model that produced it
+        self.conditioning_cache.clear()
+
+        self.generator = loaded_generator['generator']
+        self.full_precision = loaded_generator['full_precision']
+
+        if self.generator is not None:
+            self.conditioning_cache.install(
+                model=loaded_generator['model'],
+                model_key=loaded_generator['model_key'],
             )
 
+        free_memory()
+
     def dream(
         self,
         prompt,
@@ -54,8 +101,13 @@ class Dreamer():
         base_image=None,
         base_image_mask=None,
         base_image_mask_type=None,
+        base_image_mask_feather=None,
+        base_image_mask_dilate=None,
         base_image_decimation=None,
         image_progress_callback=None,
+        max_batch_size=1,
+        preview_mode='FULL',
+        previews_wanted=None,
     ):
         """
         Generate a set of images with Stable Diffusion.
@@ -85,9 +137,10 @@ class Dreamer():
         guidance_scale
             Unconditional guidance scale (how closely to follow the prompt).
         image_progress_callback
-            A callback function that gets invoked repeatedly with the total
-            progress of each image. Image previews and the final image are
-            sent to the callback when available.
+            A callback function that gets invoked with an update whenever
+            the progress of an image changes. Each update contains the
+            image's `index`, `state` and `completed_steps`, plus `image` and
+            `image_key` when a new image preview was generated.
         steps_per_image_preview:
             How many sampling steps should be run before generating a preview
             image. A value of 1 will generate a preview at every step, which
@@ -108,11 +161,28 @@ class Dreamer():
             the mask will be kept and the rest of the image will be replaced;
             `'REPLACE_MASKED'` means that only masked sections of the base
             image will be replaced and the rest of the image will be kept.
+        base_image_mask_feather
+            Radius in pixels to blur the edges of the mask by, so replaced
+            sections blend into the kept sections.
+        base_image_mask_dilate
+            Radius in pixels to grow the replaced sections of the mask by.
         base_image_decimation
             Value between 0.0 and 1.0 indicating the strength used for
             noising/denoising the base image. Must be set when `base_image`
             is set. A value of 1.0 completely decimates the input image,
             discarding most details.
+        max_batch_size
+            The maximum number of images to denoise together in a single
+            sampler run. Batching is only used without a base image (txt2img
+            mode), and batches are split in half if they run out of memory.
+        preview_mode
+            `'FULL'` decodes previews with the VAE like final images;
+            `'APPROXIMATE'` maps the latents straight to RGB instead, which
+            is nearly free but much blurrier.
+        previews_wanted
+            A function called before generating each preview, which returns
+            `False` if nobody is watching the dream. Previews are skipped
+            while it returns `False`.
         """
         if sampler == 'DDIM':
             sampler_name = 'ddim'
@@ -137,10 +207,14 @@ class Dreamer():
             assert base_image_mask_type is not None, 'base_image_mask_type must be set if base_image_mask is set'
             image_mask = prepare_image_mask(
                 base_image_mask,
-                base_image_mask_type
+                base_image_mask_type,
+                feather=base_image_mask_feather,
+                dilate=base_image_mask_dilate,
             )
         else:
             assert base_image_mask_type is None, 'base_image_mask_type can only be set if base_image_mask is set'
+            assert base_image_mask_feather is None, 'base_image_mask_feather can only be set if base_image_mask is set'
+            assert base_image_mask_dilate is None, 'base_image_mask_dilate can only be set if base_image_mask is set'
         images = [
             {
                 'index': i,
@@ -154,45 +228,62 @@ class Dreamer():
             for i in range(num_images)
         ]
 
-        results = []
-        for image in images:
-            step_callback = make_img_callback(
-                image_progress_callback=image_progress_callback,
-                generator=self.generator,
-                images=images,
-                image_index=image['index'],
-                steps_per_image_preview=steps_per_image_preview,
-            )
-
-            result = self.generator.prompt2image(
+        if base_image is None and max_batch_size > 1 and can_batch_prompt(prompt):
+            results = self.dream_batched(
                 prompt=prompt,
-                iterations=1,
-                steps=sampler_steps,
-                seed=image['seed'],
-                cfg_scale=guidance_scale,
-                ddim_eta=sampler_eta,
-                skip_normalize=False,
-                image_callback=None,
-                step_callback=step_callback,
+                images=images,
                 width=width,
                 height=height,
                 sampler_name=sampler_name,
-                seamless=False,
-                log_tokenization=False,
-                with_variations=None,
-                variation_amount=0.0,
-                init_img=base_image,
-                init_mask=image_mask,
-                fit=False,
-                strength=base_image_decimation,
-                gfpgan_strength=0,
-                save_original=False,
-                upscale=None,
+                sampler_steps=sampler_steps,
+                sampler_eta=sampler_eta,
+                guidance_scale=guidance_scale,
+                steps_per_image_preview=steps_per_image_preview,
+                image_progress_callback=image_progress_callback,
+                max_batch_size=max_batch_size,
+                preview_mode=preview_mode,
+                previews_wanted=previews_wanted,
             )
-            results += result
+        else:
+            results = []
+            for image in images:
+                step_callback = make_img_callback(
+                    image_progress_callback=image_progress_callback,
+                    generator=self.generator,
+                    image=image,
+                    steps_per_image_preview=steps_per_image_preview,
+                    preview_mode=preview_mode,
+                    previews_wanted=previews_wanted,
+                )
+
+                result = self.generator.prompt2image(
+                    prompt=prompt,
+                    iterations=1,
+                    steps=sampler_steps,
+                    seed=image['seed'],
+                    cfg_scale=guidance_scale,
+                    ddim_eta=sampler_eta,
+                    skip_normalize=False,
+                    image_callback=None,
+                    step_callback=step_callback,
+                    width=width,
+                    height=height,
+                    sampler_name=sampler_name,
+                    seamless=False,
+                    log_tokenization=False,
+                    with_variations=None,
+                    variation_amount=0.0,
+                    init_img=base_image,
+                    init_mask=image_mask,
+                    fit=False,
+                    strength=base_image_decimation,
+                    gfpgan_strength=0,
+                    save_original=False,
+                    upscale=None,
+                )
+                results += result
 
-            image['state'] = 'complete'
-            image_progress_callback(image_progress=images)
+                report_image_complete(image, actual_sampler_steps, image_progress_callback)
 
         for index, result in enumerate(results):
             image, seed = result
@@ -207,12 +298,96 @@ class Dreamer():
             'seed': seed,
         }
 
+    def dream_batched(
+        self,
+        prompt,
+        images,
+        width,
+        height,
+        sampler_name,
+        sampler_steps,
+        sampler_eta,
+        guidance_scale,
+        steps_per_image_preview,
+        image_progress_callback,
+        max_batch_size,
+        preview_mode='FULL',
+        previews_wanted=None,
+    ):
+        if width is None:
+            width = self.generator.width
+        if height is None:
+            height = self.generator.height
+
+        # Round down to a multiple of 64, like the single-image path does
+        width = width - width % 64
+        height = height - height % 64
+
+        results = []
+        batch_size = max_batch_size
+        remaining_images = images
+        while len(remaining_images) > 0:
+            batch = remaining_images[:batch_size]
+            step_callbacks = [
+                make_img_callback(
+                    image_progress_callback=image_progress_callback,
+                    generator=self.generator,
+                    image=image,
+                    steps_per_image_preview=steps_per_image_preview,
+                    preview_mode=preview_mode,
+                    previews_wanted=previews_wanted,
+                )
+                for image in batch
+            ]
+
+            try:
+                batch_results = sample_batch(
+                    generator=self.generator,
+                    prompt=prompt,
+                    seeds=[image['seed'] for image in batch],
+                    width=width,
+                    height=height,
+                    sampler_name=sampler_name,
+                    sampler_steps=sampler_steps,
+                    sampler_eta=sampler_eta,
+                    guidance_scale=guidance_scale,
+                    full_precision=self.full_precision,
+                    step_callbacks=step_callbacks,
+                )
+            except RuntimeError as error:
+                if batch_size == 1 or not is_out_of_memory_error(error):
+                    raise
+
+                batch_size = batch_size // 2
+                print(f"ran out of memory generating {len(batch)} images at once, retrying with a batch size of {batch_size}")
+                free_memory()
+                continue
+
+            results += batch_results
+            remaining_images = remaining_images[len(batch):]
+
+            for image in batch:
+                report_image_complete(image, sampler_steps, image_progress_callback)
+
+        return results
+
+def report_image_complete(image, completed_steps, image_progress_callback):
+    image['state'] = 'complete'
+    image['completed_steps'] = completed_steps
+    if image_progress_callback is not None:
+        image_progress_callback(image_progress={
+            'index': image['index'],
+            'state': image['state'],
+            'completed_steps': image['completed_steps'],
+        })
+
 def make_img_callback(
     image_progress_callback,
     generator,
-    images,
-    image_index,
+    image,
     steps_per_image_preview,
+    preview_mode='FULL',
+    previews_wanted=None,
 ):
     if image_progress_callback is None:
         return None
@@ -220,34 +395,24 @@ def make_img_callback(
     previews_enabled = steps_per_image_preview > 0
 
     def img_callback(image_samples, step_index):
-        images[image_index]['state'] = 'running'
-        images[image_index]['completed_steps'] = step_index
+        image['state'] = 'running'
+        image['completed_steps'] = step_index
 
-        should_generate_preview = previews_enabled and step_index % steps_per_image_preview == 0
-        if should_generate_preview:
-            preview_image = generator.sample_to_image(image_samples)
+        image_progress = {
+            'index': image['index'],
+            'state': image['state'],
+            'completed_steps': image['completed_steps'],
+        }
 
-            images[image_index]['image'] = preview_image
-            images[image_index]['image_key'] = f'preview_{ULID()}'
+        should_generate_preview = (
+            previews_enabled
+            and step_index % steps_per_image_preview == 0
+            and (previews_wanted is None or previews_wanted())
+        )
+        if should_generate_preview:
+            image_progress['image'] = sample_to_preview_image(generator, image_samples, preview_mode)
+            image_progress['image_key'] = f'preview_{ULID()}'
 
-        image_progress_callback(image_progress=images)
+        image_progress_callback(image_progress=image_progress)
 
     return img_callback
-
-def prepare_image_mask(
-    mask,
-    mask_type,
-):
-    if mask_type == 'KEEP_MASKED':
-        return mask
-    elif mask_type == 'REPLACE_MASKED':
-        # Invert the alpha channel of each pixel in the mask
-        mask_data = mask.convert("RGBA").getdata()
-        new_mask_data = [(pixel[0], pixel[1], pixel[2], 255 - pixel[3]) for pixel in mask_data]
-
-        new_mask = Image.new(mode="RGBA", size=mask.size)
-        new_mask.putdata(new_mask_data)
-
-        return new_mask
-    else:
-        raise Exception(f'Unknown mask type: {mask_type}')
@@ -0,0 +1,88 @@
+import numpy
+from PIL import Image, ImageChops, ImageFilter
+
+MASK_TYPES = ('KEEP_MASKED', 'REPLACE_MASKED')
+
+# Limits how much work feathering and dilating a mask can take
+MAX_MASK_RADIUS = 128
+
+def prepare_image_mask(mask, mask_type, feather=None, dilate=None):
+    """
+    Turn an uploaded mask into the mask used for inpainting. Only the alpha
+    channel of the returned mask matters: opaque sections of the base image
+    are kept and transparent sections are replaced.
+
+    mask
+        An image the same size as the base image, usually RGBA.
+    mask_type
+        `'KEEP_MASKED'` to keep the sections covered by the mask, or
+        `'REPLACE_MASKED'` to replace them (which inverts the alpha channel).
+    feather
+        Radius in pixels to blur the edge of the mask by, so the replaced
+        sections blend into the rest of the image.
+    dilate
+        Radius in pixels to grow the replaced sections by before
+        feathering.
+    """
+    if mask_type not in MASK_TYPES:
+        raise Exception(f'Unknown mask type: {mask_type}')
+
+    if mask_type == 'KEEP_MASKED' and not feather and not dilate:
+        return mask
+
+    # Masks without an alpha channel (L or RGB) are fully opaque
+    mask = mask.convert('RGBA')
+
+    # Work on the alpha channel on its own, so each step is a single pass
+    # over one band in C instead of building a tuple per pixel
+    alpha = mask.getchannel('A')
+    if mask_type == 'REPLACE_MASKED':
+        alpha = ImageChops.invert(alpha)
+
+    if dilate:
+        alpha = dilate_mask(alpha, dilate)
+
+    if feather:
+        alpha = alpha.filter(ImageFilter.GaussianBlur(feather))
+
+    mask.putalpha(alpha)
+    return mask
+
+def dilate_mask(alpha, radius):
+    """
+    Grow the transparent sections of an alpha channel by `radius` pixels
+    (using a square window).
+    """
+    # A square minimum filter is separable, so filter rows then columns
+    data = numpy.asarray(alpha)
+    data = sliding_minimum(data, 2 * radius + 1, axis=1)
+    data = sliding_minimum(data, 2 * radius + 1, axis=0)
+    return Image.fromarray(data, mode='L')
+
+def sliding_minimum(data, window, axis):
+    """
+    Return the minimum of each centered `window` along `axis`. Windows are
+    built up by doubling, so this takes O(log window) array operations
+    instead of one per pixel in the window.
+    """
+    pad = window // 2
+    pad_width = [(0, 0)] * data.ndim
+    pad_width[axis] = (pad, pad)
+    padded = numpy.pad(data, pad_width, mode='constant', constant_values=255)
+
+    length = padded.shape[axis]
+    minimums = padded
+    span = 1
+    while span * 2 <= window:
+        minimums = numpy.minimum(
+            minimums.take(numpy.arange(0, length - span * 2 + 1), axis=axis),
+            minimums.take(numpy.arange(span, length - span + 1), axis=axis),
+        )
+        span *= 2
+
+    # Cover the window with two (possibly overlapping) spans
+    num_windows = data.shape[axis]
+    return numpy.minimum(
+        minimums.take(numpy.arange(0, num_windows), axis=axis),
+        minimums.take(numpy.arange(window - span, window - span + num_windows), axis=axis),
+    )
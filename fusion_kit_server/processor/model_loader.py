@@ -0,0 +1,124 @@
+import threading
+import traceback
+
+def get_model_settings(settings):
+    """
+    Return the subset of `settings` that requires loading a different model
+    when changed. All other settings can be applied to a running runner
+    between dreams.
+    """
+    active_model = next((model for model in settings['models'] if model['is_active']), None)
+
+    return {
+        'weights_filename': active_model['weights_filename'] if active_model is not None else None,
+        'config_filename': active_model['config_filename'] if active_model is not None else None,
+        'device': settings['device'],
+        'use_full_precision': settings['use_full_precision'],
+    }
+
+class ModelLoader():
+    """
+    Loads a new generator for a `Dreamer` in a background thread, so the
+    current generator can keep serving dreams until the new one is ready.
+    Both models are held in memory until the swap happens.
+
+    `model_settings` only changes once a new model has been swapped in, so
+    a failed load leaves the current model in place and asking for the same
+    model again retries the load. `on_load_failed` gets called with the
+    error (from the loader thread) when a load fails.
+    """
+
+    def __init__(self, dreamer, settings, on_load_failed=None):
+        self.dreamer = dreamer
+        self.on_load_failed = on_load_failed
+        self.lock = threading.Lock()
+        self.load_id = 0
+        self.model_settings = get_model_settings(settings)
+        self.pending_model_settings = None
+        self.loaded_generator = None
+        self.load_error = None
+        self.load_finished = threading.Event()
+        self.load_finished.set()
+
+    def update(self, settings):
+        """
+        Start loading the model for `settings` if it isn't the current model
+        or the model that's already being loaded.
+        """
+        new_model_settings = get_model_settings(settings)
+
+        with self.lock:
+            target_model_settings = self.pending_model_settings or self.model_settings
+            if new_model_settings == target_model_settings:
+                return
+
+            # A newer load supersedes any load that's still in progress
+            self.load_id += 1
+            self.loaded_generator = None
+            self.load_error = None
+
+            if new_model_settings == self.model_settings:
+                # Switching back to the current model, so nothing to load
+                self.pending_model_settings = None
+                self.load_finished.set()
+                return
+
+            load_id = self.load_id
+            self.pending_model_settings = new_model_settings
+            load_finished = self.load_finished = threading.Event()
+
+        def load():
+            print("loading new model")
+            try:
+                loaded_generator = self.dreamer.create_generator(settings)
+            except Exception as error:
+                print("failed to load new model, keeping the current model:")
+                traceback.print_exc()
+
+                with self.lock:
+                    is_current_load = load_id == self.load_id
+                    if is_current_load:
+                        self.pending_model_settings = None
+                        self.load_error = error
+
+                load_finished.set()
+                if is_current_load and self.on_load_failed is not None:
+                    self.on_load_failed(error)
+                return
+
+            with self.lock:
+                if load_id == self.load_id:
+                    self.loaded_generator = loaded_generator
+
+            load_finished.set()
+            print("new model loaded")
+
+        thread = threading.Thread(target=load, name='model-loader', daemon=True)
+        thread.start()
+
+    def is_loading(self):
+        with self.lock:
+            return self.pending_model_settings is not None
+
+    def wait(self):
+        """
+        Block until the model that's being loaded (if any) has either loaded
+        or failed to load.
+        """
+        with self.lock:
+            load_finished = self.load_finished
+
+        load_finished.wait()
+
+    def swap_if_ready(self):
+        with self.lock:
+            loaded_generator = self.loaded_generator
+            model_settings = self.pending_model_settings
+            if loaded_generator is not None:
+                self.loaded_generator = None
+                self.pending_model_settings = None
+
+        if loaded_generator is not None:
+            print("switching to new model")
+            self.dreamer.use_generator(loaded_generator)
+            self.model_settings = model_settings
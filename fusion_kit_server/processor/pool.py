@@ -0,0 +1,140 @@
+import asyncio
+from .runner_process import RunnerProcess
+from .shared_images import import_shared_image
+
+# A slot that keeps losing its runner is skipped by the scheduler (unless
+# every slot is unhealthy) until one of its requests completes again
+MAX_CONSECUTIVE_FAILURES = 3
+
+class RunnerSlot():
+    """
+    One device's place in the runner pool. A slot has a primary runner that
+    handles requests, and optionally a warm standby runner that takes over
+    if the primary dies.
+    """
+
+    def __init__(self, processor, index, device, cpu_threads=None):
+        self.processor = processor
+        self.index = index
+        self.device = device
+        self.cpu_threads = cpu_threads
+        self.runner = None
+        self.standby_runner = None
+        self.consecutive_failures = 0
+
+    @property
+    def name(self):
+        return f"{self.index}-{self.device or 'default'}"
+
+    @property
+    def settings(self):
+        settings = dict(self.processor.settings)
+        if self.device is not None:
+            settings['device'] = self.device
+        if self.cpu_threads is not None:
+            settings['cpu_threads'] = self.cpu_threads
+        return settings
+
+    def is_running(self):
+        return self.runner is not None and self.runner.is_alive()
+
+    def is_healthy(self):
+        return self.consecutive_failures < MAX_CONSECUTIVE_FAILURES
+
+    def num_active_requests(self):
+        return sum(
+            1 for active_request in self.processor.active_requests.values()
+            if active_request['slot'] is self
+        )
+
+    def run(self):
+        if not self.is_running():
+            if self.runner is not None:
+                self.runner.terminate()
+
+            if self.standby_runner is not None and self.standby_runner.is_alive():
+                print(f"promoting standby runner {self.name}")
+                self.runner = self.standby_runner
+            else:
+                self.runner = self.start_runner(name=self.name)
+
+            self.standby_runner = None
+
+        if self.processor.warm_standby and (self.standby_runner is None or not self.standby_runner.is_alive()):
+            # The standby loads its model right away, then sits idle until
+            # it gets promoted
+            self.standby_runner = self.start_runner(name=f"{self.name}-standby")
+
+    def start_runner(self, name):
+        runner = RunnerProcess(name=name, settings=self.settings, data_dir=self.processor.data_dir)
+        runner.start()
+        runner.router_task = asyncio.create_task(runner_router(self.processor, self, runner))
+        return runner
+
+    def update_settings(self):
+        for runner in (self.runner, self.standby_runner):
+            if runner is not None and runner.is_alive():
+                runner.update_settings(self.settings)
+
+    def terminate(self):
+        for runner in (self.runner, self.standby_runner):
+            if runner is not None:
+                runner.terminate()
+
+async def runner_router(processor, slot, runner):
+    while True:
+        event_type, payload = await runner.events.get()
+
+        if runner.retired:
+            # Events from a runner that has been replaced are stale, since
+            # its requests have been retried or failed already
+            return
+
+        if event_type == 'response':
+            response = payload
+            if response.get('request_id') is None:
+                # Runner-level errors, like a model that failed to load
+                error = response.get('body', {}).get('error')
+                if error is not None:
+                    print(f"runner {runner.name} error: {error}")
+                continue
+
+            import_response_images(response, runner.release_queue)
+            processor.publish_response(response)
+
+            request_id = response.get("request_id")
+            is_stopped = response.get("stopped", False)
+            if request_id is not None and is_stopped:
+                completed = response.get('body', {}).get('state') == 'complete'
+                await processor.finish_request(request_id, slot, completed=completed)
+        elif event_type == 'exit':
+            if runner is slot.runner:
+                await processor.recover_slot(slot)
+            elif runner is slot.standby_runner:
+                print(f"standby runner {runner.name} exited")
+                runner.terminate()
+                slot.standby_runner = None
+                slot.consecutive_failures += 1
+                if slot.is_healthy():
+                    slot.run()
+            return
+
+def import_response_images(response, release_queue):
+    """
+    Copy a response's images out of shared memory. If any image's block is
+    gone, the response is turned into an error for its request, since the
+    dream can't be finished without it.
+    """
+    body = response.get('body', {})
+
+    missing_image = False
+    for image in body.get('images', []):
+        if image.get('image') is not None:
+            image['image'] = import_shared_image(image['image'], release_queue)
+            if image['image'] is None:
+                missing_image = True
+
+    if missing_image:
+        response['body'] = {
+            'error': "generated image is no longer available",
+        }
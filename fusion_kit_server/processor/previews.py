@@ -0,0 +1,66 @@
+from io import BytesIO
+from PIL import Image, features
+
+DEFAULT_PREVIEW_MAX_EDGE = 256
+
+PREVIEW_QUALITY = 70
+
+# Previews are only shown for a few seconds, so they're encoded for speed
+# rather than size
+PREVIEW_FORMAT = 'webp' if features.check('webp') else 'jpeg'
+
+PREVIEW_SAVE_OPTIONS = {
+    'webp': {'quality': PREVIEW_QUALITY, 'method': 0},
+    'jpeg': {'quality': PREVIEW_QUALITY},
+}
+
+# How much each of Stable Diffusion's 4 latent channels contributes to the
+# red, green and blue of the decoded image, roughly
+LATENT_RGB_FACTORS = [
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+]
+
+def approximate_sample_to_image(samples):
+    """
+    Turn latent samples into a preview image without running the VAE
+    decoder. The preview is a blurry approximation of the final image, at
+    latent resolution (1/8 of the image size), but costs next to nothing.
+    """
+    import torch
+
+    latents = samples[0].float()
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=latents.dtype, device=latents.device)
+
+    rgb = torch.einsum('lhw,lr->hwr', latents, factors)
+    rgb = ((rgb + 1.0) / 2.0).clamp(0.0, 1.0).mul(255).byte()
+
+    return Image.fromarray(rgb.cpu().numpy(), mode='RGB')
+
+def sample_to_preview_image(generator, samples, preview_mode):
+    if preview_mode == 'APPROXIMATE':
+        return approximate_sample_to_image(samples)
+    elif preview_mode == 'FULL':
+        return generator.sample_to_image(samples)
+    else:
+        raise Exception(f'Unknown preview mode: {preview_mode}')
+
+def encode_preview(image, max_edge):
+    """
+    Scale a preview image down to at most `max_edge` pixels wide or tall
+    and encode it, so only a few kilobytes get sent back from the runner.
+    """
+    preview = image.convert('RGB')
+    preview.thumbnail((max_edge, max_edge), resample=Image.BILINEAR, reducing_gap=2.0)
+
+    data = BytesIO()
+    preview.save(data, format=PREVIEW_FORMAT, **PREVIEW_SAVE_OPTIONS[PREVIEW_FORMAT])
+
+    return {
+        'data': data.getvalue(),
+        'format': PREVIEW_FORMAT,
+        'width': preview.width,
+        'height': preview.height,
+    }
@@ -1,64 +1,180 @@
 import sys
+import traceback
+from .model_loader import ModelLoader
+from .previews import DEFAULT_PREVIEW_MAX_EDGE, encode_preview
+from .shared_images import SharedImagePool
 
-def processor_runner(settings, data_dir, req_queue, res_queue):
+class DreamCancelledError(Exception):
+    pass
+
+def processor_runner(settings, data_dir, req_queue, res_queue, release_queue, cancelled_request, previews_request):
     sys.path.append('./invoke_ai')
     from .dreamer import Dreamer
 
     print("started processor")
 
+    if settings.get('cpu_threads') is not None:
+        import torch
+        torch.set_num_threads(settings['cpu_threads'])
+
     # Allow the processor to exit even if the queues still have data
     req_queue.cancel_join_thread()
     res_queue.cancel_join_thread()
+    release_queue.cancel_join_thread()
 
     dreamer = Dreamer(settings=settings, data_dir=data_dir)
+    image_pool = SharedImagePool(release_queue=release_queue)
+    try:
+        run_requests(
+            dreamer=dreamer,
+            settings=settings,
+            req_queue=req_queue,
+            res_queue=res_queue,
+            image_pool=image_pool,
+            cancelled_request=cancelled_request,
+            previews_request=previews_request,
+        )
+    finally:
+        image_pool.close()
+
+def run_requests(dreamer, settings, req_queue, res_queue, image_pool, cancelled_request, previews_request):
+    def on_model_load_failed(error):
+        # Not tied to any request, so the server just logs it
+        res_queue.put({
+            'request_id': None,
+            'stopped': False,
+            'body': {
+                'error': Exception(f"Failed to load model: {error}"),
+            }
+        })
+
+    model_loader = ModelLoader(dreamer=dreamer, settings=settings, on_load_failed=on_model_load_failed)
+
     while True:
         request = req_queue.get()
         request_id = request['request_id']
         request_type = request['request']
         request_body = request['body']
+
+        model_loader.swap_if_ready()
+
         if request_type == 'dream':
+            if dreamer.generator is None and model_loader.is_loading():
+                # There's no current model to keep using in the meantime
+                print("waiting for model to load")
+                model_loader.wait()
+                model_loader.swap_if_ready()
+
+            if dreamer.generator is None:
+                if model_loader.load_error is not None:
+                    error = Exception(f"Failed to load model: {model_loader.load_error}")
+                else:
+                    error = Exception("No model is active")
+
+                res_queue.put({
+                    'request_id': request_id,
+                    'stopped': True,
+                    'body': {
+                        'error': error,
+                    }
+                })
+                continue
+
             def image_progress_callback(image_progress):
+                # This gets called between sampler steps, so raising here
+                # stops the dream as soon as possible after it's cancelled
+                if cancelled_request.value == request_id.encode():
+                    raise DreamCancelledError()
+
                 res_queue.put({
                     'request_id': request_id,
                     'stopped': False,
                     'body': {
                         'state': 'running',
-                        'image_progress': image_progress,
+                        'image_update': encode_image_update(
+                            image_progress,
+                            preview_max_edge=settings.get('preview_max_edge', DEFAULT_PREVIEW_MAX_EDGE),
+                        ),
                     }
                 })
 
+            def previews_wanted():
+                # Decoding previews is wasted work if nobody is watching
+                return previews_request.value == request_id.encode()
+
             if settings['show_previews']:
                 steps_per_image_preview = settings['steps_per_preview']
             else:
                 steps_per_image_preview = 0
 
             options = request_body['options']
-            result = dreamer.dream(
-                prompt=options['prompt'],
-                num_images=options['num_images'],
-                seed=options['seed'],
-                width=options.get('width'),
-                height=options.get('height'),
-                base_image=options.get('base_image'),
-                base_image_mask=options.get('base_image_mask'),
-                base_image_mask_type=options.get('base_image_mask_type'),
-                base_image_decimation=options.get('base_image_decimation'),
-                sampler=options['sampler'],
-                sampler_steps=options['sampler_steps'],
-                sampler_eta=options['sampler_eta'],
-                guidance_scale=options['guidance_scale'],
-                steps_per_image_preview=steps_per_image_preview,
-                image_progress_callback=image_progress_callback,
-            )
+            try:
+                result = dreamer.dream(
+                    prompt=options['prompt'],
+                    num_images=options['num_images'],
+                    seed=options['seed'],
+                    width=options.get('width'),
+                    height=options.get('height'),
+                    base_image=options.get('base_image'),
+                    base_image_mask=options.get('base_image_mask'),
+                    base_image_mask_type=options.get('base_image_mask_type'),
+                    base_image_mask_feather=options.get('base_image_mask_feather'),
+                    base_image_mask_dilate=options.get('base_image_mask_dilate'),
+                    base_image_decimation=options.get('base_image_decimation'),
+                    sampler=options['sampler'],
+                    sampler_steps=options['sampler_steps'],
+                    sampler_eta=options['sampler_eta'],
+                    guidance_scale=options['guidance_scale'],
+                    steps_per_image_preview=steps_per_image_preview,
+                    image_progress_callback=image_progress_callback,
+                    max_batch_size=settings.get('max_batch_size', 1),
+                    preview_mode=settings.get('preview_mode', 'FULL'),
+                    previews_wanted=previews_wanted,
+                )
+            except DreamCancelledError:
+                print(f"dream {request_id} cancelled")
+                res_queue.put({
+                    'request_id': request_id,
+                    'stopped': True,
+                    'body': {
+                        'state': 'cancelled',
+                    }
+                })
+                continue
+            except Exception as error:
+                # Errors like a bad mask would just happen again if the
+                # request got retried, so only the request fails and the
+                # runner keeps going
+                print(f"dream {request_id} failed:")
+                traceback.print_exc()
+                res_queue.put({
+                    'request_id': request_id,
+                    'stopped': True,
+                    'body': {
+                        'error': str(error),
+                    }
+                })
+                continue
+
             res_queue.put({
                 'request_id': request_id,
                 'stopped': True,
                 'body': {
                     'state': 'complete',
-                    'images': result['images'],
+                    'images': [
+                        share_image(image, image_pool)
+                        for image in result['images']
+                    ],
                     'seed': result['seed'],
                 }
             })
+        elif request_type == 'update_settings':
+            new_settings = request_body['settings']
+            model_loader.update(new_settings)
+
+            # Other settings apply starting with the next dream. The model
+            # only changes once the new one has loaded
+            settings = new_settings
         elif request_type == 'stop':
             print('stopping processor')
             return
@@ -72,6 +188,28 @@ def processor_runner(settings, data_dir, req_queue, res_queue):
                 }
             })
 
+def encode_image_update(image_progress, preview_max_edge):
+    """
+    Replace the preview image in a progress update with a small encoded
+    copy. Previews are only shown briefly, so they don't need to go
+    through shared memory at full size like final images.
+    """
+    if image_progress.get('image') is None:
+        return image_progress
+
+    image_update = dict(image_progress)
+    image_update['preview'] = encode_preview(image_update.pop('image'), max_edge=preview_max_edge)
+    return image_update
+
+def share_image(image_progress, image_pool):
+    if image_progress.get('image') is None:
+        return image_progress
+
+    return {
+        **image_progress,
+        'image': image_pool.export_image(image_progress['image']),
+    }
+
 def txt2img_preview_callback(images, n, request_id, res_queue):
     res_queue.put({
         'request_id': request_id,
@@ -0,0 +1,224 @@
+import asyncio
+import multiprocessing
+from multiprocessing.reduction import ForkingPickler
+import os
+import struct
+import sys
+import threading
+from .runner import processor_runner
+
+MAX_REQUEST_ID_LENGTH = 64
+
+READ_CHUNK_SIZE = 64 * 1024
+
+class RunnerProcess():
+    """
+    A runner process along with the queues used to talk to it.
+
+    Once started, responses and the process exiting are delivered through
+    `events` as `('response', response)` and `('exit', None)` tuples. The
+    response pipe and the process's sentinel are watched by the event loop,
+    and responses are only unpickled once all of their bytes have arrived,
+    so the event loop never waits on the runner.
+    """
+
+    def __init__(self, name, settings, data_dir):
+        self.name = name
+        self.settings = settings
+        self.data_dir = data_dir
+        self.process = None
+        self.retired = False
+        self.events = None
+        self.loop = None
+        self.response_buffer = bytearray()
+
+        self.req_queue = multiprocessing.Queue()
+        self.res_queue = multiprocessing.Queue()
+        self.release_queue = multiprocessing.Queue()
+
+        # Holds the ID of a cancelled request, which the runner checks between
+        # sampler steps
+        self.cancelled_request = multiprocessing.Array('c', MAX_REQUEST_ID_LENGTH)
+
+        # Holds the ID of the request that someone is watching, which the
+        # runner checks before generating each preview
+        self.previews_request = multiprocessing.Array('c', MAX_REQUEST_ID_LENGTH)
+
+        self.req_queue.cancel_join_thread()
+        self.res_queue.cancel_join_thread()
+        self.release_queue.cancel_join_thread()
+
+    def start(self):
+        print(f"starting {self.name} runner")
+        self.process = multiprocessing.Process(
+            target=processor_runner,
+            name=f"fusion-kit-runner-{self.name}",
+            kwargs={
+                'settings': self.settings,
+                'data_dir': self.data_dir,
+                'req_queue': self.req_queue,
+                'res_queue': self.res_queue,
+                'release_queue': self.release_queue,
+                'cancelled_request': self.cancelled_request,
+                'previews_request': self.previews_request,
+            }
+        )
+        self.process.start()
+        self.watch()
+
+    def watch(self):
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue()
+
+        # Only the runner writes responses. Closing our copy of the write end
+        # means the pipe reaches EOF once the runner exits, rather than
+        # waiting forever for the rest of a message it didn't finish writing
+        self.res_queue._writer.close()
+
+        if sys.platform == 'win32':
+            # Windows event loops can't watch pipes (the selector loop only
+            # supports sockets, and the proactor loop has no `add_reader`),
+            # so fall back to reading responses on a thread
+            thread = threading.Thread(
+                target=read_runner_events,
+                args=(self, self.loop),
+                name=f"fusion-kit-runner-{self.name}-events",
+                daemon=True,
+            )
+            thread.start()
+            return
+
+        response_fd = self.res_queue._reader.fileno()
+        os.set_blocking(response_fd, False)
+        self.loop.add_reader(response_fd, self._read_responses)
+        self.loop.add_reader(self.process.sentinel, self._handle_exit)
+
+    def _read_responses(self):
+        """
+        Read whatever is waiting in the response pipe without blocking, and
+        emit each response that has fully arrived.
+        """
+        response_fd = self.res_queue._reader.fileno()
+        is_open = True
+        while True:
+            try:
+                data = os.read(response_fd, READ_CHUNK_SIZE)
+            except BlockingIOError:
+                break
+            except OSError:
+                is_open = False
+                break
+
+            if len(data) == 0:
+                is_open = False
+                break
+
+            self.response_buffer += data
+
+        for response in take_complete_messages(self.response_buffer):
+            self.events.put_nowait(('response', response))
+
+        if not is_open:
+            # Nothing more will arrive, so the sentinel alone is left to
+            # watch for the process exiting
+            self.loop.remove_reader(response_fd)
+
+    def _handle_exit(self):
+        self.loop.remove_reader(self.process.sentinel)
+
+        # The runner may have written responses right before it exited
+        if not self.res_queue._reader.closed:
+            self._read_responses()
+            self.loop.remove_reader(self.res_queue._reader.fileno())
+            self.res_queue._reader.close()
+
+        if len(self.response_buffer) > 0:
+            print(f"warning: {self.name} runner exited partway through a response, discarding it")
+            self.response_buffer.clear()
+
+        self.events.put_nowait(('exit', None))
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def send(self, request_id, request, body):
+        self.req_queue.put({
+            'request_id': request_id,
+            'request': request,
+            'body': body,
+        })
+
+    def cancel(self, request_id):
+        self.cancelled_request.value = request_id.encode()
+
+    def set_previews_request(self, request_id):
+        self.previews_request.value = request_id.encode() if request_id is not None else b''
+
+    def update_settings(self, settings):
+        self.settings = settings
+        self.send(
+            request_id=None,
+            request='update_settings',
+            body={
+                'settings': settings,
+            },
+        )
+
+    def terminate(self):
+        self.retired = True
+        if self.process is not None:
+            self.process.terminate()
+
+def read_runner_events(runner, loop):
+    """
+    Pass each of a runner's responses to the event loop as they arrive, then
+    an `exit` event once the runner exits. Runs on its own thread, since
+    reading a response can block until the runner finishes writing it. Only
+    used where the event loop can't watch the response pipe itself.
+    """
+    def post_event(event):
+        try:
+            loop.call_soon_threadsafe(runner.events.put_nowait, event)
+        except RuntimeError:
+            # The event loop has already been closed
+            return False
+
+        return True
+
+    while True:
+        try:
+            response = runner.res_queue.get()
+        except (EOFError, OSError):
+            break
+
+        if not post_event(('response', response)):
+            return
+
+    post_event(('exit', None))
+
+def take_complete_messages(buffer):
+    """
+    Remove and unpickle each complete message at the start of `buffer`,
+    using the same framing as `multiprocessing.Connection`: a 4-byte
+    big-endian length (or -1 followed by an 8-byte length for messages over
+    2GB), then the pickled message. A trailing partial message is left in
+    `buffer` until the rest of it arrives.
+    """
+    messages = []
+    while len(buffer) >= 4:
+        size, = struct.unpack('!i', buffer[:4])
+        header_size = 4
+        if size == -1:
+            if len(buffer) < 12:
+                break
+            size, = struct.unpack('!Q', buffer[4:12])
+            header_size = 12
+
+        if len(buffer) < header_size + size:
+            break
+
+        message = bytes(buffer[header_size:header_size + size])
+        del buffer[:header_size + size]
+        messages.append(ForkingPickler.loads(message))
+
+    return messages
@@ -0,0 +1,135 @@
+from multiprocessing import resource_tracker, shared_memory
+import queue
+from PIL import Image
+
+DEFAULT_MAX_BLOCKS = 32
+
+def is_shared_image(value):
+    return isinstance(value, dict) and 'shared_memory' in value
+
+class SharedImagePool():
+    """
+    A pool of shared memory blocks used to send images from the runner
+    process to the server without pickling them.
+
+    The runner owns every block in the pool. Exporting an image copies its
+    pixels into a free block and returns a small handle that can be put on a
+    queue in place of the image. Once the server has copied the pixels out
+    with `import_shared_image`, it puts the block's name on `release_queue`
+    so the block can be reused. If every block is in use and the pool is
+    full, images are sent as-is instead.
+    """
+
+    def __init__(self, release_queue, max_blocks=DEFAULT_MAX_BLOCKS):
+        self.release_queue = release_queue
+        self.max_blocks = max_blocks
+        self.blocks = {}
+        self.free_blocks = set()
+
+    def export_image(self, image):
+        self._collect_released()
+
+        data = image.tobytes()
+        block = self._acquire_block(len(data))
+        if block is None:
+            return image
+
+        block.buf[:len(data)] = data
+        return {
+            'shared_memory': block.name,
+            'mode': image.mode,
+            'size': image.size,
+            'nbytes': len(data),
+        }
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+
+        self.blocks.clear()
+        self.free_blocks.clear()
+
+    def _collect_released(self):
+        while True:
+            try:
+                name = self.release_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            if name in self.blocks:
+                self.free_blocks.add(name)
+
+    def _acquire_block(self, nbytes):
+        # Reuse the smallest free block that fits
+        fitting_blocks = [
+            self.blocks[name]
+            for name in self.free_blocks
+            if self.blocks[name].size >= nbytes
+        ]
+        if len(fitting_blocks) > 0:
+            block = min(fitting_blocks, key=lambda block: block.size)
+            self.free_blocks.discard(block.name)
+            return block
+
+        if len(self.blocks) >= self.max_blocks:
+            # Make room by dropping a free block that's too small
+            if len(self.free_blocks) == 0:
+                return None
+
+            small_block = self.blocks.pop(self.free_blocks.pop())
+            small_block.close()
+            small_block.unlink()
+
+        block = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.blocks[block.name] = block
+        return block
+
+def attach_shared_memory(name):
+    """
+    Attach to a shared memory block owned by the runner without registering
+    it with the resource tracker. The runner registers and unlinks its own
+    blocks; a second registration from the server would get the block
+    unlinked again (or reported as leaked) when the server exits.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+
+    # Python < 3.13 can't attach without tracking, and unregistering
+    # afterwards would also drop the runner's registration, since spawned
+    # runners share the server's resource tracker. So skip registering
+    # instead (this only ever runs on the event loop thread)
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+def import_shared_image(handle, release_queue):
+    """
+    Copy an image out of a shared memory block created by `SharedImagePool`,
+    then hand the block back to the runner.
+    """
+    if not is_shared_image(handle):
+        return handle
+
+    try:
+        block = attach_shared_memory(handle['shared_memory'])
+    except FileNotFoundError:
+        print(f"warning: shared image block {handle['shared_memory']} no longer exists")
+        return None
+
+    try:
+        image = Image.frombytes(
+            handle['mode'],
+            handle['size'],
+            bytes(block.buf[:handle['nbytes']]),
+        )
+    finally:
+        block.close()
+        release_queue.put(handle['shared_memory'])
+
+    return image
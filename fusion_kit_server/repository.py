@@ -0,0 +1,89 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import json
+from sqlalchemy import select
+import db
+import dream_history
+import thumbnails
+
+DB_SETTINGS_KEY = 'settings_v0'
+
+DEFAULT_MAX_READERS = 4
+
+class Repository():
+    """
+    Async access to the database for the event loop.
+
+    Queries run on a pool of reader threads, and writes are handed to
+    `db_writer`, so waiting on the database never blocks other requests or
+    websocket traffic.
+    """
+
+    def __init__(self, db_config, db_writer, max_readers=DEFAULT_MAX_READERS):
+        self.db_config = db_config
+        self.db_writer = db_writer
+        self.executor = ThreadPoolExecutor(max_workers=max_readers, thread_name_prefix='db-reader')
+
+    async def _read(self, read_fn, /, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(read_fn, *args, **kwargs))
+
+    async def run_migrations(self):
+        await self._read(run_migrations, self.db_config)
+
+    async def load_settings_json(self):
+        return await self._read(load_settings_json)
+
+    async def save_settings_json(self, settings_json):
+        await self.db_writer.write(partial(save_settings_json, settings_json=settings_json))
+
+    async def get_dream(self, dream_id):
+        return await self._read(dream_history.get_dream, dream_id)
+
+    async def list_dreams(self, first=None, after=None, prompt=None):
+        return await self._read(dream_history.list_dreams, first=first, after=after, prompt=prompt)
+
+    async def search_dreams(self, query, first=None, after=None):
+        return await self._read(dream_history.search_dreams, query=query, first=first, after=after)
+
+    async def delete_dream(self, blob_store, dream_id):
+        return await self.db_writer.write(partial(dream_history.delete_dream_rows, blob_store=blob_store, dream_id=dream_id))
+
+    async def get_dream_images(self, dream_ids):
+        return await self._read(dream_history.get_dream_images, dream_ids)
+
+    async def get_dream_image_thumbnails(self, dream_image_ids):
+        return await self._read(thumbnails.get_thumbnails, dream_image_ids)
+
+    async def collect_garbage(self, blob_store):
+        return await self._read(blob_store.collect_garbage)
+
+    async def find_missing_thumbnails(self, sizes, after_id, limit):
+        return await self._read(thumbnails.find_missing_thumbnails, sizes=sizes, after_id=after_id, limit=limit)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+def run_migrations(db_config):
+    with db_config.db_engine.connect() as db_conn:
+        db.run_db_migrations(db_config=db_config, db_conn=db_conn)
+
+def load_settings_json():
+    with db.Session() as session:
+        settings_row = session.execute(
+            select(db.Settings)
+                .where(db.Settings.key == DB_SETTINGS_KEY)
+                .limit(1)
+        ).scalar()
+
+        if settings_row is None:
+            return None
+
+        return json.loads(settings_row.settings_json)
+
+def save_settings_json(session, settings_json):
+    session.merge(db.Settings(
+        key=DB_SETTINGS_KEY,
+        settings_json=json.dumps(settings_json),
+    ))
@@ -0,0 +1,120 @@
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+
+DEFAULT_MAX_BUFFERED = 64
+
+class Subscription():
+    """
+    A subscriber's buffer of messages for one topic, iterated with
+    `async for`.
+
+    The buffer holds at most `max_buffered` messages. When a slow subscriber
+    falls behind, the oldest buffered message is dropped to make room for
+    the newest one. With `max_buffered=None` nothing is ever dropped, for
+    subscribers that need every message. Iteration ends after the topic's
+    final message.
+
+    With `min_interval` set, messages are handed out at most once every
+    `min_interval` seconds, except for the final message which is handed out
+    right away. With `max_buffered=1`, this coalesces a stream of snapshots
+    down to the latest one at the requested rate.
+    """
+
+    def __init__(self, max_buffered=DEFAULT_MAX_BUFFERED, min_interval=None):
+        self.max_buffered = max_buffered
+        self.min_interval = min_interval
+        self.messages = deque()
+        self.closed = False
+        self.last_delivered_at = None
+        self.message_available = asyncio.Event()
+
+    def push(self, message, final=False):
+        if self.closed:
+            return
+
+        if self.max_buffered is not None and len(self.messages) >= self.max_buffered:
+            self.messages.popleft()
+
+        self.messages.append(message)
+        self.closed = final
+        self.message_available.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            if len(self.messages) == 0:
+                if self.closed:
+                    raise StopAsyncIteration
+
+                self.message_available.clear()
+                await self.message_available.wait()
+                continue
+
+            if self.min_interval is not None and self.last_delivered_at is not None and not self.closed:
+                delay = self.last_delivered_at + self.min_interval - loop.time()
+                if delay > 0:
+                    # Wait out the interval, unless the final message shows
+                    # up in the meantime
+                    self.message_available.clear()
+                    try:
+                        await asyncio.wait_for(self.message_available.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+            self.last_delivered_at = loop.time()
+            return self.messages.popleft()
+
+class Router():
+    """
+    Delivers messages to the subscribers of a topic, such as a single
+    request's responses or a single dream's updates, so publishing only
+    costs as much as the number of interested subscribers.
+
+    Topics are any hashable value, and only exist while they have
+    subscribers. Publishing never blocks.
+    """
+
+    def __init__(self):
+        self.subscriptions = {}
+        self.topic_listeners = []
+
+    def add_topic_listener(self, listener):
+        """
+        Call `listener(topic, has_subscribers)` whenever a topic gets its
+        first subscriber or loses its last one.
+        """
+        self.topic_listeners.append(listener)
+
+    def _notify_topic_listeners(self, topic, has_subscribers):
+        for listener in self.topic_listeners:
+            listener(topic, has_subscribers)
+
+    def publish(self, topic, message, final=False):
+        for subscription in list(self.subscriptions.get(topic, ())):
+            subscription.push(message, final=final)
+
+    def has_subscribers(self, topic):
+        return topic in self.subscriptions
+
+    @contextmanager
+    def subscribe(self, topic, max_buffered=DEFAULT_MAX_BUFFERED, min_interval=None):
+        subscription = Subscription(max_buffered=max_buffered, min_interval=min_interval)
+        is_new_topic = topic not in self.subscriptions
+        self.subscriptions.setdefault(topic, set()).add(subscription)
+        if is_new_topic:
+            self._notify_topic_listeners(topic, True)
+
+        try:
+            yield subscription
+        finally:
+            topic_subscriptions = self.subscriptions.get(topic)
+            topic_subscriptions.discard(subscription)
+            if len(topic_subscriptions) == 0:
+                del self.subscriptions[topic]
+                self._notify_topic_listeners(topic, False)
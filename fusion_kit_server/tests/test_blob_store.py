@@ -0,0 +1,89 @@
+"""
+Check that blobs are kept while any dream uses them, and deleted by garbage
+collection once none do.
+
+Run from the `fusion_kit_server` directory:
+
+    python -m unittest discover -s tests -t .
+"""
+
+import json
+import os
+import tempfile
+import unittest
+from blob_store import BlobStore
+import db
+import dream_history
+
+SERVER_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+
+class BlobStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_config = db.DbConfig(
+            alembic_ini_path=os.path.join(SERVER_DIR, 'alembic.ini'),
+            alembic_script_path=os.path.join(SERVER_DIR, 'alembic'),
+            db_path=os.path.join(self.temp_dir.name, 'fusion-kit.db'),
+        )
+        with self.db_config.db_engine.connect() as db_conn:
+            db.run_db_migrations(db_config=self.db_config, db_conn=db_conn)
+
+        self.images_dir = os.path.join(self.temp_dir.name, 'images')
+        self.blob_store = BlobStore(images_dir=self.images_dir)
+
+    def tearDown(self):
+        self.db_config.db_engine.dispose()
+        self.temp_dir.cleanup()
+
+    def add_dream(self, dream_id, blob):
+        with db.Session() as session:
+            self.blob_store.add_ref(session, blob)
+            session.add(db.Dream(
+                id=dream_id,
+                prompt='a red fox',
+                seed=1,
+                num_images=1,
+                settings_json=json.dumps({'options': {}}),
+            ))
+            session.add(db.DreamImage(
+                id=f'di_{dream_id}',
+                dream_id=dream_id,
+                seed=1,
+                index=0,
+                image_path=blob['image_path'],
+                width=1,
+                height=1,
+                blurhash='',
+                blob_hash=blob['hash'],
+            ))
+            session.commit()
+
+    def delete_dream(self, dream_id):
+        with db.Session() as session:
+            dream_image_ids = dream_history.delete_dream_rows(session, blob_store=self.blob_store, dream_id=dream_id)
+            session.commit()
+
+        return dream_image_ids
+
+    def test_shared_blob_is_deleted_after_last_reference(self):
+        blob = self.blob_store.put(b'image data', extension='png')
+        self.assertEqual(self.blob_store.put(b'image data', extension='png'), blob)
+        self.add_dream('dream_1', blob)
+        self.add_dream('dream_2', blob)
+        blob_path = self.blob_store.path(blob['hash'], blob['extension'])
+
+        self.assertEqual(self.delete_dream('dream_1'), ['di_dream_1'])
+        self.assertEqual(self.blob_store.collect_garbage(), 0)
+        self.assertTrue(os.path.isfile(blob_path))
+        self.assertEqual(dream_history.get_dream_image_key('di_dream_2'), ('blob', blob['hash'], 'png'))
+
+        self.delete_dream('dream_2')
+        self.assertEqual(self.blob_store.collect_garbage(), 1)
+        self.assertFalse(os.path.isfile(blob_path))
+        self.assertIsNone(dream_history.get_dream('dream_2'))
+
+    def test_delete_missing_dream(self):
+        self.assertIsNone(self.delete_dream('dream_missing'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+"""
+Run the dream history queries end to end, against a freshly migrated
+database.
+
+Run from the `fusion_kit_server` directory:
+
+    python -m unittest discover -s tests -t .
+"""
+
+import json
+import os
+import tempfile
+import unittest
+from ariadne import gql, graphql
+import db
+from repository import Repository
+import domain.graphql
+
+SERVER_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+SCHEMA_PATH = os.path.join(SERVER_DIR, '..', 'schema.graphql')
+
+class HistoryManager():
+    """
+    Just enough of `FusionKitManager` to resolve persisted dreams.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+
+    async def get_dream(self, dream_id):
+        return await self.repository.get_dream(dream_id)
+
+    async def list_dreams(self, first=None, after=None, prompt=None):
+        return await self.repository.list_dreams(first=first, after=after, prompt=prompt)
+
+    async def search_dreams(self, query, first=None, after=None):
+        return await self.repository.search_dreams(query=query, first=first, after=after)
+
+    def get_image_uri(self, key):
+        return f"/images/{'/'.join(key)}.png"
+
+    def get_thumbnail_uri(self, dream_image_id, db_thumbnails, size):
+        return None
+
+class DreamQueriesTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_config = db.DbConfig(
+            alembic_ini_path=os.path.join(SERVER_DIR, 'alembic.ini'),
+            alembic_script_path=os.path.join(SERVER_DIR, 'alembic'),
+            db_path=os.path.join(self.temp_dir.name, 'fusion-kit.db'),
+        )
+        self.repository = Repository(db_config=self.db_config, db_writer=None)
+        await self.repository.run_migrations()
+
+        settings = {
+            'options': {
+                'prompt': 'a red fox in the snow',
+                'seed': 100,
+                'num_images': 2,
+                'sampler_steps': 10,
+            },
+        }
+        with db.Session() as session:
+            session.add(db.Dream(
+                id='dream_1',
+                prompt=settings['options']['prompt'],
+                seed=settings['options']['seed'],
+                num_images=settings['options']['num_images'],
+                settings_json=json.dumps(settings),
+            ))
+            for index in range(settings['options']['num_images']):
+                session.add(db.DreamImage(
+                    id=f'di_{index}',
+                    dream_id='dream_1',
+                    seed=settings['options']['seed'] + index,
+                    index=index,
+                    image_path=f'di_{index}/image.png',
+                    width=512,
+                    height=512,
+                    blurhash='',
+                ))
+            session.commit()
+
+        with open(SCHEMA_PATH) as file:
+            self.schema = domain.graphql.make_schema(gql(file.read()))
+
+    async def asyncTearDown(self):
+        self.repository.close()
+        self.db_config.db_engine.dispose()
+        self.temp_dir.cleanup()
+
+    async def execute(self, query):
+        context = domain.graphql.context_builder(HistoryManager(self.repository))(None)
+        success, result = await graphql(self.schema, {'query': query}, context_value=context)
+        self.assertTrue(success)
+        self.assertNotIn('errors', result)
+        return result['data']
+
+    async def test_dreams_images(self):
+        data = await self.execute("""
+            {
+                dreams {
+                    nodes {
+                        id
+                        images {
+                            id
+                            ... on FinishedDreamImage { seed width height imagePath }
+                        }
+                    }
+                }
+            }
+        """)
+
+        self.assertEqual(data['dreams']['nodes'], [
+            {
+                'id': 'dream_1',
+                'images': [
+                    {'id': 'di_0', 'seed': 100, 'width': 512, 'height': 512, 'imagePath': '/images/di_0/image.png'},
+                    {'id': 'di_1', 'seed': 101, 'width': 512, 'height': 512, 'imagePath': '/images/di_1/image.png'},
+                ],
+            },
+        ])
+
+    async def test_search_dreams_images(self):
+        data = await self.execute('{ searchDreams(query: "fox") { nodes { id images { id } } } }')
+
+        self.assertEqual(data['searchDreams']['nodes'], [
+            {'id': 'dream_1', 'images': [{'id': 'di_0'}, {'id': 'di_1'}]},
+        ])
+
+    async def test_dream_images(self):
+        data = await self.execute('{ dream(id: "dream_1") { id images { id } } }')
+
+        self.assertEqual(data['dream'], {'id': 'dream_1', 'images': [{'id': 'di_0'}, {'id': 'di_1'}]})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+"""
+Check that responses read from a runner's pipe are only unpickled once all
+of their bytes have arrived.
+
+Run from the `fusion_kit_server` directory:
+
+    python -m unittest discover -s tests -t .
+"""
+
+from multiprocessing.reduction import ForkingPickler
+import struct
+import unittest
+from processor.runner_process import take_complete_messages
+
+def encode_message(message):
+    """
+    Frame `message` the way `multiprocessing.Queue` writes it to its pipe.
+    """
+    data = bytes(ForkingPickler.dumps(message))
+    return struct.pack('!i', len(data)) + data
+
+class TakeCompleteMessagesTest(unittest.TestCase):
+    def test_takes_each_complete_message(self):
+        messages = [{'request_id': 'a'}, {'request_id': 'b', 'body': {'seed': 1}}]
+        buffer = bytearray()
+        for message in messages:
+            buffer += encode_message(message)
+
+        self.assertEqual(take_complete_messages(buffer), messages)
+        self.assertEqual(buffer, bytearray())
+
+    def test_leaves_partial_message(self):
+        data = encode_message({'request_id': 'a'}) + encode_message({'request_id': 'b'})
+        buffer = bytearray(data[:-3])
+
+        self.assertEqual(take_complete_messages(buffer), [{'request_id': 'a'}])
+        self.assertEqual(take_complete_messages(buffer), [])
+
+        buffer += data[-3:]
+        self.assertEqual(take_complete_messages(buffer), [{'request_id': 'b'}])
+        self.assertEqual(buffer, bytearray())
+
+if __name__ == '__main__':
+    unittest.main()
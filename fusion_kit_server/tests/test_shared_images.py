@@ -0,0 +1,64 @@
+"""
+Check that images sent through shared memory arrive intact, and that a block
+that has gone away fails the request instead of the response.
+
+Run from the `fusion_kit_server` directory:
+
+    python -m unittest discover -s tests -t .
+"""
+
+import queue
+import unittest
+from PIL import Image
+from processor.pool import import_response_images
+from processor.shared_images import SharedImagePool
+
+def make_response(images):
+    return {
+        'request_id': 'request-1',
+        'stopped': True,
+        'body': {
+            'state': 'complete',
+            'images': [{'state': 'complete', 'image': image} for image in images],
+            'seed': 1,
+        },
+    }
+
+class ImportResponseImagesTest(unittest.TestCase):
+    def setUp(self):
+        self.release_queue = queue.Queue()
+        self.image_pool = SharedImagePool(self.release_queue)
+
+    def tearDown(self):
+        self.image_pool.close()
+
+    def test_imports_shared_images(self):
+        image = Image.new('RGB', (4, 3), color=(10, 20, 30))
+        response = make_response([self.image_pool.export_image(image)])
+
+        import_response_images(response, self.release_queue)
+
+        imported_image = response['body']['images'][0]['image']
+        self.assertEqual(imported_image.tobytes(), image.tobytes())
+        self.assertEqual(self.release_queue.qsize(), 1)
+
+    def test_missing_block_becomes_error(self):
+        image = Image.new('RGB', (4, 3))
+        handles = [self.image_pool.export_image(image) for _ in range(2)]
+
+        missing_block = self.image_pool.blocks.pop(handles[1]['shared_memory'])
+        missing_block.close()
+        missing_block.unlink()
+
+        response = make_response(handles)
+        import_response_images(response, self.release_queue)
+
+        self.assertTrue(response['stopped'])
+        self.assertIn('error', response['body'])
+        self.assertNotIn('state', response['body'])
+
+        # The block that was still there is handed back to the runner
+        self.assertEqual(self.release_queue.get_nowait(), handles[0]['shared_memory'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
+import re
+from PIL import Image, features
+from sqlalchemy import select
+import db
+
+# Sizes are the maximum width or height of a thumbnail, in pixels
+DEFAULT_THUMBNAIL_SIZES = (256, 512)
+
+THUMBNAIL_QUALITY = 80
+
+BACKFILL_BATCH_SIZE = 100
+
+# WebP is much smaller than JPEG at the same quality, but Pillow can be
+# built without it
+THUMBNAIL_FORMAT = 'webp' if features.check('webp') else 'jpeg'
+
+THUMBNAIL_EXTENSIONS = {
+    'webp': 'webp',
+    'jpeg': 'jpg',
+}
+
+THUMBNAIL_MEDIA_TYPES = {
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+}
+
+def parse_thumbnail_sizes(value):
+    sizes = sorted(set(int(size) for size in value.split(',') if size.strip() != ''))
+    if any(size < 1 for size in sizes):
+        raise ValueError(f"invalid thumbnail sizes: {value}")
+
+    return sizes
+
+def pick_thumbnail_size(sizes, requested_size):
+    """
+    Pick the smallest thumbnail size that's at least as big as
+    `requested_size`, or the biggest size if none are. Returns `None` if
+    there are no thumbnail sizes.
+    """
+    if len(sizes) == 0:
+        return None
+
+    return next((size for size in sorted(sizes) if size >= requested_size), max(sizes))
+
+THUMBNAIL_FILENAME_REGEX = r'\Athumbnail-([1-9][0-9]*)\.([a-z]+)\Z'
+
+def thumbnail_filename(size, thumbnail_format):
+    return f'thumbnail-{size}.{THUMBNAIL_EXTENSIONS[thumbnail_format]}'
+
+def parse_thumbnail_filename(filename):
+    """
+    Return the `(size, format)` of a thumbnail filename, or `None` if it
+    isn't a valid thumbnail filename.
+    """
+    result = re.match(THUMBNAIL_FILENAME_REGEX, filename)
+    if result is None:
+        return None
+
+    size, extension = result.groups()
+    thumbnail_format = next(
+        (thumbnail_format for thumbnail_format, format_extension in THUMBNAIL_EXTENSIONS.items() if format_extension == extension),
+        None,
+    )
+    if thumbnail_format is None:
+        return None
+
+    return int(size), thumbnail_format
+
+def make_thumbnail(image, size):
+    thumbnail = image.convert('RGB')
+    thumbnail.thumbnail((size, size), resample=Image.LANCZOS, reducing_gap=2.0)
+    return thumbnail
+
+def save_thumbnails(images_dir, dream_image_id, image, sizes):
+    """
+    Write a thumbnail of `image` for each size into the dream image's
+    directory. Thumbnails are never bigger than the image itself. Returns
+    the details to store for each thumbnail.
+    """
+    image_dir = os.path.join(images_dir, dream_image_id)
+    os.makedirs(image_dir, exist_ok=True)
+
+    saved_thumbnails = []
+    for size in sizes:
+        thumbnail = make_thumbnail(image, size)
+        thumbnail_path = os.path.join(image_dir, thumbnail_filename(size, THUMBNAIL_FORMAT))
+
+        # Write to a temporary file first so the thumbnail route never
+        # serves a partially-written thumbnail
+        thumbnail.save(f'{thumbnail_path}.tmp', format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+        os.replace(f'{thumbnail_path}.tmp', thumbnail_path)
+
+        saved_thumbnails.append({
+            'size': size,
+            'format': THUMBNAIL_FORMAT,
+            'image_path': os.path.relpath(thumbnail_path, start=images_dir),
+            'width': thumbnail.width,
+            'height': thumbnail.height,
+        })
+
+    return saved_thumbnails
+
+def add_thumbnail_rows(session, dream_image_id, saved_thumbnails):
+    for saved_thumbnail in saved_thumbnails:
+        session.add(db.DreamImageThumbnail(
+            dream_image_id=dream_image_id,
+            size=saved_thumbnail['size'],
+            format=saved_thumbnail['format'],
+            image_path=saved_thumbnail['image_path'],
+            width=saved_thumbnail['width'],
+            height=saved_thumbnail['height'],
+        ))
+
+def get_thumbnails(dream_image_ids):
+    """
+    Return the thumbnail rows of each dream image in `dream_image_ids` with a
+    single query, as a list of rows for each dream image.
+    """
+    db_thumbnails_by_image_id = {dream_image_id: [] for dream_image_id in dream_image_ids}
+    if len(dream_image_ids) == 0:
+        return []
+
+    with db.Session() as session:
+        db_thumbnails = session.execute(
+            select(db.DreamImageThumbnail)
+                .where(db.DreamImageThumbnail.dream_image_id.in_(db_thumbnails_by_image_id.keys()))
+        ).scalars()
+        for db_thumbnail in db_thumbnails:
+            db_thumbnails_by_image_id[db_thumbnail.dream_image_id].append(db_thumbnail)
+
+    return [db_thumbnails_by_image_id[dream_image_id] for dream_image_id in dream_image_ids]
+
+def find_missing_thumbnails(sizes, after_id, limit):
+    """
+    Return up to `limit` dream images after `after_id` (by ID), along with
+    the sizes each is missing a thumbnail for.
+    """
+    with db.Session() as session:
+        query = select(db.DreamImage).order_by(db.DreamImage.id).limit(limit)
+        if after_id is not None:
+            query = query.where(db.DreamImage.id > after_id)
+        db_images = session.execute(query).scalars().all()
+
+        existing_sizes = {db_image.id: set() for db_image in db_images}
+        db_thumbnails = session.execute(
+            select(db.DreamImageThumbnail)
+                .where(db.DreamImageThumbnail.dream_image_id.in_(existing_sizes.keys()))
+        ).scalars()
+        for db_thumbnail in db_thumbnails:
+            existing_sizes[db_thumbnail.dream_image_id].add(db_thumbnail.size)
+
+    return [
+        {
+            'dream_image_id': db_image.id,
+            'image_path': db_image.image_path,
+            'missing_sizes': [size for size in sizes if size not in existing_sizes[db_image.id]],
+        }
+        for db_image in db_images
+    ]
+
+def backfill_image_thumbnails(images_dir, dream_image_id, image_path, sizes):
+    path = os.path.join(images_dir, image_path)
+    if not os.path.isfile(path):
+        print(f"skipping thumbnails for {dream_image_id} (image not found)")
+        return []
+
+    with Image.open(path) as image:
+        return save_thumbnails(images_dir, dream_image_id, image, sizes)
+
+async def backfill_thumbnails(repository, db_writer, images_dir, sizes, max_workers=None):
+    """
+    Generate any missing thumbnails for images that were persisted before
+    thumbnails existed (or before a size was configured).
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='thumbnails')
+
+    num_thumbnails = 0
+    after_id = None
+    try:
+        while True:
+            images = await repository.find_missing_thumbnails(
+                sizes=sizes,
+                after_id=after_id,
+                limit=BACKFILL_BATCH_SIZE,
+            )
+            if len(images) == 0:
+                break
+
+            after_id = images[-1]['dream_image_id']
+            images = [image for image in images if len(image['missing_sizes']) > 0]
+
+            saved_thumbnails = await asyncio.gather(*[
+                loop.run_in_executor(
+                    executor,
+                    backfill_image_thumbnails,
+                    images_dir,
+                    image['dream_image_id'],
+                    image['image_path'],
+                    image['missing_sizes'],
+                )
+                for image in images
+            ])
+
+            await asyncio.gather(*[
+                db_writer.write(partial(
+                    add_thumbnail_rows,
+                    dream_image_id=image['dream_image_id'],
+                    saved_thumbnails=image_thumbnails,
+                ))
+                for image, image_thumbnails in zip(images, saved_thumbnails)
+            ])
+
+            num_thumbnails += sum(len(image_thumbnails) for image_thumbnails in saved_thumbnails)
+
+            print(f"backfilled {num_thumbnails} thumbnail(s)")
+    finally:
+        executor.shutdown(wait=True)
+
+    return num_thumbnails
@@ -0,0 +1,254 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+from PIL import Image, ImageOps, UnidentifiedImageError
+from starlette.responses import PlainTextResponse
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+DEFAULT_MAX_PIXELS = 64 * 1000 * 1000
+
+# Room in a request for the GraphQL query and multipart framing, on top of
+# the uploaded files themselves
+REQUEST_OVERHEAD_BYTES = 1024 * 1024
+
+# A dream can upload a base image and a mask
+MAX_UPLOADS_PER_REQUEST = 2
+
+# Used when no model is active yet
+DEFAULT_MODEL_SIZE = (512, 512)
+
+DEFAULT_MAX_WORKERS = min(2, os.cpu_count() or 1)
+
+# Stable Diffusion works in 8x8 latents, and the dreamer rounds sizes down
+# to a multiple of 64 anyway
+SIZE_MULTIPLE = 64
+
+# Only these decoders are tried on uploaded files
+ALLOWED_FORMATS = ('PNG', 'JPEG', 'WEBP', 'BMP', 'GIF')
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+# EXIF orientations that swap the width and height
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+class UploadError(Exception):
+    pass
+
+class RequestTooLargeError(Exception):
+    pass
+
+def max_request_bytes(max_upload_bytes):
+    return MAX_UPLOADS_PER_REQUEST * max_upload_bytes + REQUEST_OVERHEAD_BYTES
+
+class MaxBodySizeMiddleware():
+    """
+    Rejects HTTP requests with a body bigger than `max_body_bytes` with a
+    413 response. The body is counted as it's received, so oversized uploads
+    get cut off before Starlette spools the whole file to disk.
+    """
+
+    def __init__(self, app, max_body_bytes):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope['headers'])
+        content_length = headers.get(b'content-length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_body_bytes:
+            await self.reject(scope, receive, send)
+            return
+
+        num_bytes = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal num_bytes
+            message = await receive()
+            if message['type'] == 'http.request':
+                num_bytes += len(message.get('body', b''))
+                if num_bytes > self.max_body_bytes:
+                    raise RequestTooLargeError()
+
+            return message
+
+        async def tracked_send(message):
+            nonlocal response_started
+            if message['type'] == 'http.response.start':
+                response_started = True
+
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracked_send)
+        except RequestTooLargeError:
+            if response_started:
+                raise
+
+            await self.reject(scope, receive, send)
+
+    async def reject(self, scope, receive, send):
+        response = PlainTextResponse(
+            f"Request is too large (max is {self.max_body_bytes} bytes)",
+            status_code=413,
+        )
+        await response(scope, receive, send)
+
+def upload_size(file):
+    position = file.tell()
+    try:
+        return file.seek(0, os.SEEK_END)
+    finally:
+        file.seek(position)
+
+def open_upload(upload, max_bytes, max_pixels):
+    """
+    Open an uploaded image without decoding it. Only the image header is
+    read, so uploads that are too big (in bytes or in pixels) or that
+    aren't images get rejected before any pixel data is decoded.
+    """
+    num_bytes = upload_size(upload.file)
+    if num_bytes > max_bytes:
+        raise UploadError(f"{upload.filename} is too large ({num_bytes} bytes, max is {max_bytes} bytes)")
+
+    upload.file.seek(0)
+    try:
+        image = Image.open(upload.file, formats=ALLOWED_FORMATS)
+    except (UnidentifiedImageError, Image.DecompressionBombError) as error:
+        raise UploadError(f"{upload.filename} is not a supported image") from error
+
+    width, height = image.size
+    if width * height > max_pixels:
+        image.close()
+        raise UploadError(f"{upload.filename} is too large ({width}x{height}, max is {max_pixels} pixels)")
+
+    return image
+
+def fit_size(image_size, model_size):
+    """
+    Return the size to use for a base image: the same aspect ratio as
+    `image_size`, scaled down to at most the area of `model_size`, and
+    rounded down to a multiple of `SIZE_MULTIPLE`. Images are never scaled
+    up, except that each side is at least `SIZE_MULTIPLE` pixels (so very
+    thin images get stretched slightly).
+    """
+    width, height = image_size
+    model_width, model_height = model_size
+
+    scale = min(1.0, math.sqrt((model_width * model_height) / (width * height)))
+    return (
+        max(SIZE_MULTIPLE, int(width * scale) // SIZE_MULTIPLE * SIZE_MULTIPLE),
+        max(SIZE_MULTIPLE, int(height * scale) // SIZE_MULTIPLE * SIZE_MULTIPLE),
+    )
+
+def decode_image(image, size, mode):
+    """
+    Decode `image` and resize it to exactly `size`, cropping from the center
+    if the aspect ratio doesn't match.
+    """
+    # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale for much less work. The
+    # orientation isn't applied yet, so ask for enough pixels either way
+    max_edge = max(size)
+    image.draft(None, (max_edge, max_edge))
+
+    image = ImageOps.exif_transpose(image)
+    image = image.convert(mode)
+
+    if image.size == size:
+        return image
+
+    return ImageOps.fit(image, size, method=Image.LANCZOS)
+
+def image_mode(image):
+    if 'A' in image.getbands() or 'transparency' in image.info:
+        return 'RGBA'
+
+    return 'RGB'
+
+def prepare_base_images(base_image_upload, base_image_mask_upload, model_size, max_bytes, max_pixels):
+    """
+    Check, decode and resize a base image and its optional mask. Raises
+    `UploadError` if either upload is rejected or can't be decoded.
+    """
+    try:
+        return decode_base_images(
+            base_image_upload,
+            base_image_mask_upload,
+            model_size=model_size,
+            max_bytes=max_bytes,
+            max_pixels=max_pixels,
+        )
+    except (OSError, SyntaxError, ValueError) as error:
+        # Pillow raises these for truncated or corrupt image data, which
+        # only shows up once the pixels get decoded
+        raise UploadError(f"base image could not be decoded: {error}") from error
+
+def decode_base_images(base_image_upload, base_image_mask_upload, model_size, max_bytes, max_pixels):
+    base_image = open_upload(base_image_upload, max_bytes=max_bytes, max_pixels=max_pixels)
+    base_image_mask = None
+    try:
+        if base_image_mask_upload is not None:
+            base_image_mask = open_upload(base_image_mask_upload, max_bytes=max_bytes, max_pixels=max_pixels)
+
+        # Sizes from the header don't account for EXIF rotation yet
+        width, height = base_image.size
+        orientation = base_image.getexif().get(EXIF_ORIENTATION_TAG)
+        if orientation in ROTATED_ORIENTATIONS:
+            width, height = height, width
+
+        size = fit_size((width, height), model_size)
+
+        prepared_base_image = decode_image(base_image, size, mode=image_mode(base_image))
+        prepared_base_image_mask = None
+        if base_image_mask is not None:
+            # The mask has to line up with the base image pixel for pixel
+            prepared_base_image_mask = decode_image(base_image_mask, size, mode='RGBA')
+    finally:
+        base_image.close()
+        if base_image_mask is not None:
+            base_image_mask.close()
+
+    return {
+        'base_image': prepared_base_image,
+        'base_image_mask': prepared_base_image_mask,
+    }
+
+class UploadProcessor():
+    """
+    Turns uploaded base images into images the runner can use directly.
+
+    Uploads are checked against `max_bytes` and `max_pixels` using only
+    their headers, then decoded and scaled down (or cropped) to the active
+    model's resolution on a thread pool, so large photos never block the
+    event loop or get sent to the runner at full size.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_pixels=DEFAULT_MAX_PIXELS, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='uploads')
+
+    async def prepare_base_images(self, base_image_upload, base_image_mask_upload, model_size):
+        """
+        Check, decode and resize a base image and its optional mask. Returns
+        the prepared `'base_image'` and `'base_image_mask'`, which are always
+        the same size. Raises `UploadError` if either upload is rejected.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            prepare_base_images,
+            base_image_upload,
+            base_image_mask_upload,
+            model_size,
+            self.max_bytes,
+            self.max_pixels,
+        )
+
+    def close(self):
+        self.executor.shutdown(wait=True)